@@ -0,0 +1,120 @@
+"""
+ generates synthetic release directories with a cfg/domain.cfg and `count` application templates in apps/.
+"""
+import os
+import json
+
+TEMPLATE = '''{
+  "id": "/%(app_id)s",
+  "cpus": 0.1,
+  "mem": {{mem}},
+  "instances": {{instances}},
+  "container": {
+    "type": "DOCKER",
+    "docker": {
+      "image": "mvanholsteijn/paas-monitor:{{release}}",
+      "network": "BRIDGE",
+      "portMappings": [{"containerPort": 1337, "hostPort": 0, "protocol": "tcp"}]
+    }
+  },
+  "healthChecks": [
+    {"path": "/health", "protocol": "HTTP", "portIndex": 0, "gracePeriodSeconds": 30,
+     "intervalSeconds": 10, "timeoutSeconds": 2, "maxConsecutiveFailures": 3}
+  ],
+  "env": {
+    "RELEASE": "{{release}}",
+    "MESSAGE": "hello from %(app_id)s in {{domain_name}}!"
+  },
+  "labels": {
+    "TEAM": "team-%(team)d",
+    "HAPROXY_0_VHOST": "%(app_id)s.{{external_domain_name}}"
+  }
+}
+'''
+
+CFG = '''[DEFAULT]
+instances = 1
+mem = 64
+
+[bench]
+release = 1.%(minor)d
+instances = %(instances)d
+'''
+
+
+def app_id(index):
+    return 'app-%05d' % index
+
+
+def rendered_app(index, domain_name='bench', external_domain_name='bench.example.com'):
+    """
+    returns the application definition of app `index` as rendered for the `domain_name`.
+    """
+    name = app_id(index)
+    return {
+        'id': '/%s' % name,
+        'cpus': 0.1,
+        'mem': 64,
+        'instances': 1 + index % 3,
+        'container': {
+            'type': 'DOCKER',
+            'docker': {
+                'image': 'mvanholsteijn/paas-monitor:1.%d' % (index % 7),
+                'network': 'BRIDGE',
+                'portMappings': [{'containerPort': 1337, 'hostPort': 0, 'protocol': 'tcp'}]
+            }
+        },
+        'healthChecks': [
+            {'path': '/health', 'protocol': 'HTTP', 'portIndex': 0, 'gracePeriodSeconds': 30,
+             'intervalSeconds': 10, 'timeoutSeconds': 2, 'maxConsecutiveFailures': 3}
+        ],
+        'env': {
+            'RELEASE': '1.%d' % (index % 7),
+            'MESSAGE': 'hello from %s in %s!' % (name, domain_name)
+        },
+        'labels': {
+            'TEAM': 'team-%d' % (index % 10),
+            'HAPROXY_0_VHOST': '%s.%s' % (name, external_domain_name)
+        }
+    }
+
+
+def generate_landscape(directory, count, marathon_url):
+    """
+    writes a release with `count` applications for the domain `bench` to `directory`.
+    """
+    for subdirectory in ['cfg', 'apps']:
+        if not os.path.exists(os.path.join(directory, subdirectory)):
+            os.makedirs(os.path.join(directory, subdirectory))
+
+    with open(os.path.join(directory, 'cfg', 'domain.cfg'), 'w') as file_ptr:
+        file_ptr.write('[DEFAULT]\nmarathon_url = %s\n\n[bench]\nexternal_domain_name = bench.example.com\n'
+                       % marathon_url)
+
+    for index in range(count):
+        name = app_id(index)
+        with open(os.path.join(directory, 'apps', '%s.json' % name), 'w') as file_ptr:
+            file_ptr.write(TEMPLATE % {'app_id': name, 'team': index % 10})
+        with open(os.path.join(directory, 'apps', '%s.cfg' % name), 'w') as file_ptr:
+            file_ptr.write(CFG % {'minor': index % 7, 'instances': 1 + index % 3})
+
+
+def deployed_landscape(count):
+    """
+    returns the deployed applications for a landscape of `count` applications: half of them
+    are deployed, one in ten of those with a drifted instance count, and `count` / 10 deployed
+    applications have no definition.
+    """
+    apps = []
+    for index in range(0, count, 2):
+        app = rendered_app(index)
+        if index % 20 == 0:
+            app['instances'] += 1
+        app['version'] = '2017-01-01T00:00:00.000Z'
+        apps.append(app)
+
+    for index in range(count // 10):
+        app = json.loads(json.dumps(rendered_app(index)))
+        app['id'] = '/stale-%05d' % index
+        apps.append(app)
+    return apps
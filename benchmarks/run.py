@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""
+ measures the wall time, the number of Marathon requests and the peak memory of generate, diff, deploy,
+ download and delete on synthetic landscapes, against an in-process stub Marathon.
+
+ run from the root of the repository:
+
+    python benchmarks/run.py --size 10 --size 1000 --latency 0.002 --output results.json
+    python benchmarks/run.py --size 1000 --baseline results.json --tolerance 0.25
+
+ extra options for a command are passed as --args COMMAND=OPTIONS, for instance:
+
+    python benchmarks/run.py --args 'deploy=--parallelism 8 --batch-size 100'
+
+ the commands run in sequence on the same landscape: diff sees the drift, deploy repairs it,
+ download reads everything back and delete prunes the undefined applications. On Linux, the
+ peak memory is reported in MiB.
+"""
+import os
+import sys
+import json
+import time
+import shlex
+import shutil
+import tempfile
+import subprocess
+import click
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from landscape import generate_landscape, deployed_landscape  # noqa: E402
+from tests.marathon_stub import StubMarathon  # noqa: E402
+
+COMMANDS = [
+    ('generate', ['generate', '--domain-name', 'bench', '--output-directory', 'generated']),
+    ('diff', ['diff', '--domain-name', 'bench']),
+    ('deploy', ['deploy', '--domain-name', 'bench', '--all-applications']),
+    ('download', ['download', '--domain-name', 'bench', '--directory', 'downloaded']),
+    ('delete', ['delete', '--domain-name', 'bench']),
+]
+
+
+def run_command(args, cwd):
+    """
+    runs marathon-release with `args` in `cwd` and returns the exit code, wall time in seconds and peak RSS in MiB.
+    """
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    start = time.time()
+    process = subprocess.Popen([sys.executable, '-m', 'marathon_release.cli'] + args, cwd=cwd, env=env,
+                               stdout=open(os.devnull, 'w'), stderr=open(os.devnull, 'w'))
+    _, status, usage = os.wait4(process.pid, 0)
+    elapsed = time.time() - start
+    peak = usage.ru_maxrss / 1024.0 if sys.platform != 'darwin' else usage.ru_maxrss / (1024.0 * 1024.0)
+    return os.WEXITSTATUS(status), elapsed, peak
+
+
+def benchmark(size, latency, extra_args):
+    """
+    returns a list of measurements of all commands on a landscape of `size` applications.
+    """
+    results = []
+    directory = tempfile.mkdtemp()
+    try:
+        with StubMarathon(apps=deployed_landscape(size), deployment_delay=None, latency=latency) as stub:
+            generate_landscape(directory, size, stub.url)
+            os.makedirs(os.path.join(directory, 'downloaded'))
+            for name, args in COMMANDS:
+                before = len(stub.requests)
+                exit_code, elapsed, peak = run_command(args + extra_args.get(name, []), directory)
+                results.append({'size': size, 'command': name, 'exit_code': exit_code, 'seconds': elapsed,
+                                'requests': len(stub.requests) - before, 'peak_rss_mb': peak})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def regressions(results, baseline, tolerance):
+    """
+    returns a message for each result which is slower than `tolerance` or makes more requests than its baseline.
+    """
+    previous = dict(((r['size'], r['command']), r) for r in baseline)
+    messages = []
+    for result in results:
+        reference = previous.get((result['size'], result['command']))
+        if reference is None:
+            continue
+        if result['seconds'] > reference['seconds'] * (1 + tolerance):
+            messages.append('%s on %d apps took %.3fs, baseline %.3fs' % (
+                result['command'], result['size'], result['seconds'], reference['seconds']))
+        if result['requests'] > reference['requests']:
+            messages.append('%s on %d apps made %d requests, baseline %d' % (
+                result['command'], result['size'], result['requests'], reference['requests']))
+    return messages
+
+
+@click.command()
+@click.option('--size', 'sizes', type=click.IntRange(1, None), multiple=True,
+              help='number of applications in the landscape, may be repeated. default 10 and 1000.')
+@click.option('--latency', type=float, default=0.0, help='seconds the stub Marathon delays every response.')
+@click.option('--args', 'command_args', multiple=True, help='COMMAND=OPTIONS to add to a command, may be repeated.')
+@click.option('--output', type=click.Path(dir_okay=False), help='write the results as JSON to this file.')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='results to compare against.')
+@click.option('--tolerance', type=float, default=0.2, help='allowed slow down relative to the baseline.')
+def main(sizes, latency, command_args, output, baseline, tolerance):
+    extra_args = {}
+    for command_arg in command_args:
+        name, _, options = command_arg.partition('=')
+        extra_args.setdefault(name, []).extend(shlex.split(options))
+
+    results = []
+    sys.stdout.write('%6s %-10s %9s %9s %10s\n' % ('apps', 'command', 'seconds', 'requests', 'peak MiB'))
+    for size in sizes or (10, 1000):
+        for result in benchmark(size, latency, extra_args):
+            sys.stdout.write('%6d %-10s %9.3f %9d %10.1f%s\n' % (
+                result['size'], result['command'], result['seconds'], result['requests'], result['peak_rss_mb'],
+                '' if result['exit_code'] == 0 else '  (exit %d)' % result['exit_code']))
+            results.append(result)
+
+    if output:
+        with open(output, 'w') as file_ptr:
+            json.dump(results, file_ptr, indent=2)
+
+    if baseline:
+        with open(baseline) as file_ptr:
+            messages = regressions(results, json.load(file_ptr), tolerance)
+        for message in messages:
+            sys.stderr.write('ERROR: %s\n' % message)
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
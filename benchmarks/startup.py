@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+"""
+ measures the cold start time of `marathon-release --help` and `marathon-release generate`.
+
+ run from the root of the repository:
+
+    python benchmarks/startup.py --runs 20 --max-seconds 0.5
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import click
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def cold_start(args, cwd, runs):
+    """
+    returns the median wall time in seconds of `runs` fresh interpreters running marathon-release with `args`.
+    """
+    timings = []
+    env = dict(os.environ, PYTHONPATH=ROOT, PYTHONDONTWRITEBYTECODE='1')
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-m', 'marathon_release.cli'] + args, cwd=cwd, env=env,
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        timings.append(time.time() - start)
+    return sorted(timings)[len(timings) // 2]
+
+
+@click.command()
+@click.option('--runs', type=click.IntRange(1, None), default=10, help='number of runs per command.')
+@click.option('--max-seconds', type=float, help='fail if the median start time of a command exceeds this.')
+def main(runs, max_seconds):
+    output_directory = tempfile.mkdtemp()
+    try:
+        cwd = os.path.join(ROOT, 'tests')
+        commands = [('--help', ['--help']),
+                    ('generate', ['generate', '--domain-name', 'test', '--output-directory', output_directory])]
+        failed = False
+        for name, args in commands:
+            median = cold_start(args, cwd, runs)
+            sys.stdout.write('%-10s %8.3fs\n' % (name, median))
+            failed = failed or (max_seconds is not None and median > max_seconds)
+    finally:
+        shutil.rmtree(output_directory)
+
+    if failed:
+        sys.stderr.write('ERROR: start time exceeds %.3fs\n' % max_seconds)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
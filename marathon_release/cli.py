@@ -15,28 +15,695 @@
 #   limitations under the License.
 
 import os
+import re
 import sys
-import configparser
+import time
+import codecs
+import posixpath
 
 import json
 import fnmatch
+import hashlib
+import threading
 import click
-import requests
-from jsondiff import diff as jdiff
-from jinja2 import Environment, FileSystemLoader
+from contextlib import contextmanager
+
+# requests, jinja2, jsondiff, configparser and multiprocessing are imported by the functions
+# using them, so that each command only pays the start-up time of the modules it needs.
+
+TEMPLATE_CACHE_DIR = os.path.join('.marathon-release', 'cache', 'templates')
+RENDER_CACHE_DIR = os.path.join('.marathon-release', 'cache', 'render')
+SNAPSHOT_CACHE_DIR = os.path.join('.marathon-release', 'cache', 'snapshots')
+INDEX_DIR = os.path.join('.marathon-release', 'index')
+
+# the values Marathon fills in for resource fields which are missing from an application definition.
+# Only defaults which are the same in every Marathon version are listed: others, like the backoff or the
+# unreachable strategy, changed between versions and would hide drift when assumed.
+MARATHON_DEFAULTS = {
+    'cpus': 1,
+    'disk': 0,
+    'instances': 1,
+    'mem': 128,
+}
+
+_output = threading.local()
+
+
+class _OutputBuffer(list):
+
+    def write(self, message):
+        self.append(message)
+
+
+def log(message):
+    """
+    writes `message` to stderr, or to the output buffer of the current worker thread.
+    """
+    stream = getattr(_output, 'stream', None)
+    (sys.stderr if stream is None else stream).write(message)
+
+
+def capture_output(function, item):
+    """
+    calls `function` with `item`, and returns the output written and the exception raised by the call.
+    """
+    stream = getattr(_output, 'stream', None)
+    _output.stream = _OutputBuffer()
+    try:
+        function(item)
+        return ''.join(_output.stream), None
+    except BaseException as error:
+        return ''.join(_output.stream), error
+    finally:
+        _output.stream = stream
+
+
+def run_parallel(function, items, parallelism):
+    """
+    calls `function` for each of the `items` on a pool of `parallelism` threads. The
+    output of each call is buffered and written in the order of the items. The first
+    exception raised is re-raised after the output of all the calls is written.
+    """
+    items = list(items)
+    if parallelism == 1 or len(items) < 2:
+        for item in items:
+            function(item)
+        return
+
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(min(parallelism, len(items)))
+    first_error = None
+    try:
+        for output, error in pool.imap(lambda item: capture_output(function, item), items):
+            log(output)
+            if first_error is None:
+                first_error = error
+    finally:
+        pool.terminate()
+
+    if first_error is not None:
+        raise first_error
+
+
+def select_domains(domain_names, all_domains):
+    """
+    returns the selected `domain_names`, or all domains defined in ./cfg/domain.cfg if `all_domains` is set.
+    """
+    if all_domains:
+        layers = read_config_layers(os.path.abspath(os.path.join('.', 'cfg', 'domain.cfg')))
+        domain_names = sorted(section for section in layers if section != 'DEFAULT')
+
+    if len(domain_names) == 0:
+        log('ERROR: no domain selected, specify --domain-name or --all-domains\n')
+        sys.exit(1)
+    return list(domain_names)
+
+
+def run_for_domains(domain_names, function):
+    """
+    calls `function` for each of the `domain_names` concurrently, and reports the output
+    per domain. Exits when `function` failed for any of the domains, after all domains are reported.
+    """
+    if len(domain_names) == 1:
+        function(domain_names[0])
+        return
+
+    from multiprocessing.pool import ThreadPool
+    failed = []
+    pool = ThreadPool(len(domain_names))
+    try:
+        results = pool.imap(lambda domain_name: capture_output(function, domain_name), domain_names)
+        for domain_name, (output, error) in zip(domain_names, results):
+            log('INFO: domain "%s"\n' % domain_name)
+            log(output)
+            if isinstance(error, Exception):
+                log('ERROR: failed for domain "%s", %s\n' % (domain_name, error))
+            if isinstance(error, (SystemExit, Exception)):
+                failed.append(domain_name)
+            elif error is not None:
+                raise error
+    finally:
+        pool.terminate()
+
+    if len(failed) > 0:
+        log('ERROR: failed for domain %s\n' % ', '.join('"%s"' % domain_name for domain_name in failed))
+        sys.exit(1)
+
+
+_config_layers = {}
+
+
+def read_config_layers(filename):
+    """
+    returns the uninterpolated sections of the configuration file `filename` as a dictionary,
+    including the DEFAULT section, so that it can be parsed once and overlayed many times.
+    The file is only parsed again when it has changed.
+    """
+    stat = os.stat(filename) if os.path.isfile(filename) else None
+    key = (filename, stat.st_mtime, stat.st_size) if stat is not None else (filename,)
+    if key not in _config_layers:
+        import configparser
+        config = configparser.ConfigParser(default_section=None, interpolation=None)
+        config.read(filename)
+        _config_layers[key] = {section: dict(config.items(section)) for section in config.sections()}
+    return {section: dict(options) for section, options in _config_layers[key].items()}
+
+
+_jinja_environments = {}
+
+
+def get_jinja_environment(directory, template_cache_dir=None):
+    """
+    returns the Jinja environment for the templates in `directory`, shared by all templates
+    and domains in a run. If a `template_cache_dir` is set, compiled templates are cached on disk
+    and recompiled only when the template source changes.
+    """
+    key = (directory, template_cache_dir)
+    if key not in _jinja_environments:
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        bytecode_cache = None
+        if template_cache_dir is not None:
+            if not os.path.exists(template_cache_dir):
+                os.makedirs(template_cache_dir)
+            bytecode_cache = FileSystemBytecodeCache(template_cache_dir)
+
+        _jinja_environments[key] = Environment(
+            autoescape=False,
+            loader=FileSystemLoader(directory),
+            bytecode_cache=bytecode_cache,
+            trim_blocks=False)
+    return _jinja_environments[key]
+
+
+def iter_json_array(chunks, key):
+    """
+    yields the elements of the array `key` of a JSON object read from the text `chunks`, keeping
+    only the current element in memory.
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    start = re.compile(r'"%s"\s*:\s*\[' % key)
+    buffer = ''
+    match = None
+    while match is None:
+        chunk = next(chunks, None)
+        if chunk is None:
+            return
+        buffer += chunk
+        match = start.search(buffer)
+
+    buffer = buffer[match.end():]
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+
+        try:
+            if position == len(buffer):
+                raise ValueError('no element')
+            element, position = decoder.raw_decode(buffer, position)
+            yield element
+        except ValueError:
+            chunk = next(chunks, None)
+            if chunk is None:
+                raise ValueError('unexpected end of the array "%s"' % key)
+            buffer = buffer[position:] + chunk
+            position = 0
+
+
+def iter_server_sent_events(lines):
+    """
+    yields the JSON data of the events in the server sent event stream `lines`.
+    """
+    data = []
+    for line in lines:
+        line = line.decode('utf-8') if isinstance(line, bytes) else line
+        if line == '':
+            if len(data) > 0:
+                try:
+                    yield json.loads('\n'.join(data))
+                except ValueError:
+                    pass
+            data = []
+        elif line.startswith('data:'):
+            data.append(line[len('data:'):].lstrip(' '))
+
+
+class FileWatcher(object):
+    """
+    reports the files which are created, changed or removed in `directories`, using inotify on Linux
+    and comparing the modification times and sizes every `interval` seconds elsewhere, or if `polling` is set.
+    """
+
+    # inotify events of files which are written, created, moved or removed
+    IN_EVENTS = 0x00000008 | 0x00000040 | 0x00000080 | 0x00000100 | 0x00000200
+
+    def __init__(self, directories, interval=1.0, polling=False):
+        self.directories = [os.path.abspath(directory) for directory in directories]
+        self.interval = interval
+        self.fd = None
+        self.watches = {}
+        if not polling and sys.platform.startswith('linux'):
+            self.fd = self.init_inotify()
+        self.files = self.scan() if self.fd is None else None
+
+    def init_inotify(self):
+        """
+        returns an inotify file descriptor watching the `directories`, or None if inotify is not available.
+        """
+        import ctypes
+        import ctypes.util
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+        except (OSError, AttributeError):
+            return None
+        if fd < 0:
+            return None
+
+        for directory in self.directories:
+            wd = libc.inotify_add_watch(fd, directory.encode(sys.getfilesystemencoding()), self.IN_EVENTS)
+            if wd < 0:
+                os.close(fd)
+                return None
+            self.watches[wd] = directory
+        return fd
+
+    def scan(self):
+        """
+        returns the modification time and size of every file in the `directories`.
+        """
+        files = {}
+        for directory in self.directories:
+            for filename in os.listdir(directory) if os.path.isdir(directory) else []:
+                path = os.path.join(directory, filename)
+                if os.path.isfile(path):
+                    stat = os.stat(path)
+                    files[path] = (stat.st_mtime, stat.st_size)
+        return files
+
+    def changes(self, timeout):
+        """
+        returns the set of paths which changed, waiting at most `timeout` seconds for the first change.
+        """
+        if self.fd is None:
+            time.sleep(min(timeout, self.interval))
+            files = self.scan()
+            changed = set(path for path in set(files) | set(self.files) if files.get(path) != self.files.get(path))
+            self.files = files
+            return changed
+
+        import select
+        import struct
+        changed = set()
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        while len(ready) > 0:
+            try:
+                data = os.read(self.fd, 64 * 1024)
+            except OSError:
+                break
+            position = 0
+            while position + 16 <= len(data):
+                wd, mask, cookie, length = struct.unpack_from('iIII', data, position)
+                name = data[position + 16:position + 16 + length].rstrip(b'\0')
+                if wd in self.watches and len(name) > 0:
+                    changed.add(os.path.join(self.watches[wd], name.decode(sys.getfilesystemencoding())))
+                position += 16 + length
+            # editors save in several steps, collect them as a single change
+            ready, _, _ = select.select([self.fd], [], [], 0.05)
+        return changed
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def parse_selector(expression):
+    """
+    returns the terms of the selector `expression`, a comma separated list of application id globs
+    starting with a '/' and label expressions `KEY`, `!KEY`, `KEY=VALUE` or `KEY!=VALUE`, in which the value
+    may be a glob. Each term is a tuple (kind, key, value) of kind 'id', 'has', 'has not', '=' or '!='.
+    """
+    terms = []
+    for term in [t.strip() for t in expression.split(',') if t.strip()]:
+        if term.startswith('/'):
+            terms.append(('id', None, term))
+        elif '!=' in term:
+            key, value = term.split('!=', 1)
+            terms.append(('!=', key.strip(), value.strip()))
+        elif '=' in term:
+            key, value = term.split('=', 1)
+            terms.append(('=', key.strip(), value.strip()))
+        elif term.startswith('!'):
+            terms.append(('has not', term[1:].strip(), None))
+        else:
+            terms.append(('has', term, None))
+    return terms
+
+
+def match_selector(terms, app_id, labels):
+    """
+    returns True if the application `app_id` with `labels` matches all `terms` of a selector.
+    """
+    for kind, key, value in terms:
+        if kind == 'id' and not fnmatch.fnmatchcase(app_id, value):
+            return False
+        if kind == 'has' and key not in labels:
+            return False
+        if kind == 'has not' and key in labels:
+            return False
+        if kind == '=' and not (key in labels and fnmatch.fnmatchcase('%s' % labels[key], value)):
+            return False
+        if kind == '!=' and key in labels and fnmatch.fnmatchcase('%s' % labels[key], value):
+            return False
+    return True
+
+
+def app_dependencies(app):
+    """
+    returns the absolute ids of the applications the application `app` depends on.
+    """
+    parent = posixpath.dirname(app['id'])
+    return [posixpath.normpath(posixpath.join(parent, dependency)) for dependency in app.get('dependencies') or []]
+
+
+def dependency_waves(apps):
+    """
+    returns the applications `apps` as a list of waves, in which each application only depends on
+    applications in earlier waves. Dependencies on applications outside `apps` are ignored. raises
+    a ValueError if the dependencies contain a cycle.
+    """
+    ids = set(app['id'] for app in apps)
+    deployed = set()
+    remaining = list(apps)
+    waves = []
+    while len(remaining) > 0:
+        wave = [app for app in remaining
+                if all(dependency in deployed or dependency not in ids for dependency in app_dependencies(app))]
+        if len(wave) == 0:
+            raise ValueError('circular dependencies between the applications %s' %
+                             ', '.join(sorted(app['id'] for app in remaining)))
+        waves.append(wave)
+        deployed.update(app['id'] for app in wave)
+        remaining = [app for app in remaining if app['id'] not in deployed]
+    return waves
+
+
+class RenderError(Exception):
+    pass
+
+
+class Metrics(object):
+    """
+    collects the time spent per phase and per application, and the number, latency and size
+    of the requests per Marathon endpoint. Phases are timed per thread and may be nested, so
+    concurrent work adds up to more than the wall time, and the render time of an application
+    includes loading its configuration.
+    """
+
+    # upper bounds in seconds of the buckets of the request latency histograms
+    BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+
+    def __init__(self):
+        self.started = time.time()
+        self.phases = {}
+        self.apps = {}
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name, app_id=None):
+        """
+        times the enclosed block as part of the phase `name`, and of the application `app_id` if specified.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                phase = self.phases.setdefault(name, {'count': 0, 'seconds': 0.0})
+                phase['count'] += 1
+                phase['seconds'] += elapsed
+                if app_id is not None:
+                    app = self.apps.setdefault(app_id, {})
+                    app[name] = app.get(name, 0.0) + elapsed
+
+    def endpoint(self, method, path):
+        """
+        returns the name of the endpoint of a request, with the application or group id replaced by {id}.
+        """
+        return '%s %s' % (method, re.sub(r'^(/v2/(apps|groups))/.+$', r'\1/{id}', path))
+
+    def record_request(self, method, path, seconds, status_code=None, sent=0, received=0):
+        """
+        records a request to `path`, which took `seconds` and transferred `sent` and `received` bytes.
+        A request without a `status_code` failed without a response.
+        """
+        with self.lock:
+            endpoint = self.endpoints.setdefault(self.endpoint(method, path), {
+                'count': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0,
+                'histogram': [0] * (len(self.BUCKETS) + 1)})
+            endpoint['count'] += 1
+            endpoint['errors'] += 1 if status_code is None or status_code >= 400 else 0
+            endpoint['seconds'] += seconds
+            endpoint['max_seconds'] = max(endpoint['max_seconds'], seconds)
+            endpoint['bytes_sent'] += sent
+            endpoint['bytes_received'] += received
+            endpoint['histogram'][len([b for b in self.BUCKETS if b < seconds])] += 1
+
+    def record_received(self, method, path, received):
+        """
+        adds the `received` bytes of a streamed response to the endpoint of the request.
+        """
+        with self.lock:
+            endpoint = self.endpoints.get(self.endpoint(method, path))
+            if endpoint is not None:
+                endpoint['bytes_received'] += received
+
+    def as_dict(self):
+        """
+        returns the metrics as a dictionary, with each latency histogram keyed by the upper bound of its buckets.
+        """
+        with self.lock:
+            endpoints = {}
+            for name, endpoint in self.endpoints.items():
+                endpoints[name] = dict(endpoint, histogram=dict(
+                    zip([str(b) for b in self.BUCKETS] + ['+Inf'], endpoint['histogram'])))
+            return {'seconds': time.time() - self.started,
+                    'phases': json.loads(json.dumps(self.phases)),
+                    'endpoints': endpoints,
+                    'apps': json.loads(json.dumps(self.apps))}
+
+    def summary(self, slowest=10):
+        """
+        returns the metrics as a table, including the `slowest` applications.
+        """
+        metrics = self.as_dict()
+        lines = ['%-10s %8s %10s' % ('phase', 'count', 'seconds')]
+        for name, phase in sorted(metrics['phases'].items()):
+            lines.append('%-10s %8d %10.3f' % (name, phase['count'], phase['seconds']))
+
+        if len(metrics['endpoints']) > 0:
+            lines.append('')
+            lines.append('%-24s %8s %6s %9s %9s %12s %12s' % (
+                'endpoint', 'requests', 'errors', 'mean ms', 'max ms', 'sent', 'received'))
+        for name, endpoint in sorted(metrics['endpoints'].items()):
+            lines.append('%-24s %8d %6d %9.1f %9.1f %12d %12d' % (
+                name, endpoint['count'], endpoint['errors'], 1000 * endpoint['seconds'] / endpoint['count'],
+                1000 * endpoint['max_seconds'], endpoint['bytes_sent'], endpoint['bytes_received']))
+
+        apps = sorted(metrics['apps'].items(), key=lambda item: -sum(item[1].values()))[:slowest]
+        if len(apps) > 0:
+            lines.append('')
+            lines.append('%-40s %10s  %s' % ('slowest applications', 'seconds', 'phases'))
+            for app_id, phases in apps:
+                lines.append('%-40s %10.3f  %s' % (app_id, sum(phases.values()), ', '.join(
+                    '%s %.3f' % (name, seconds) for name, seconds in sorted(phases.items()))))
+        return '\n'.join(lines) + '\n'
+
+
+class WriteScheduler(object):
+    """
+    sends writes to Marathon with at most `limit` in flight, retrying them with jittered exponential backoff
+    while Marathon answers 409 (the application is locked by a deployment), 429 or 5xx. The limit is adapted
+    to Marathon: it grows by one for every `limit` successful writes, up to `max_limit`, and is halved when
+    Marathon is overloaded, that is when it answers 429 or 5xx or is much slower than before.
+    """
+
+    # a write is slow when it takes longer than both this factor times the fastest write and the minimum
+    SLOW_FACTOR = 4
+    SLOW_SECONDS = 0.5
+
+    def __init__(self, max_limit, max_retries=5, base_delay=0.5, max_delay=30):
+        self.limit = float(max_limit)
+        self.max_limit = max_limit
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.in_flight = 0
+        self.fastest = None
+        self.decreased = 0
+        self.condition = threading.Condition()
+
+    def retryable(self, result):
+        """
+        returns True if the write may succeed when it is sent again.
+        """
+        if result.status_code == 409:
+            try:
+                body = result.json()
+            except ValueError:
+                return False
+            return isinstance(body, dict) and ('deployments' in body or 'locked' in body.get('message', ''))
+        return result.status_code == 429 or result.status_code >= 500
+
+    def retry_delay(self, result, attempt):
+        """
+        returns the seconds to wait before the next `attempt`, as requested by the Retry-After header
+        of the `result` or a random part of the exponential backoff.
+        """
+        retry_after = result.headers.get('Retry-After')
+        if retry_after is not None:
+            try:
+                return min(max(float(retry_after), 0), self.max_delay)
+            except ValueError:
+                from email.utils import parsedate_tz, mktime_tz
+                date = parsedate_tz(retry_after)
+                if date is not None:
+                    return min(max(mktime_tz(date) - time.time(), 0), self.max_delay)
+
+        import random
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, started, latency, overloaded):
+        """
+        frees the slot of a write started at `started`, and adapts the limit to its outcome.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            self.fastest = latency if self.fastest is None else min(self.fastest, latency)
+            if latency > max(self.SLOW_FACTOR * self.fastest, self.SLOW_SECONDS):
+                overloaded = True
+
+            if overloaded:
+                # writes which started before the last decrease reflect the load before it
+                if started > self.decreased:
+                    self.limit = max(1.0, self.limit / 2)
+                    self.decreased = time.time()
+            else:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+    def execute(self, description, send):
+        """
+        calls `send` to write `description` to Marathon, until the write no longer needs to be retried or
+        `max_retries` retries have been made, and returns the last response.
+        """
+        attempt = 0
+        while True:
+            self.acquire()
+            started = time.time()
+            result = None
+            try:
+                result = send()
+            finally:
+                overloaded = result is None or result.status_code == 429 or result.status_code >= 500
+                self.release(started, time.time() - started, overloaded)
+
+            if attempt >= self.max_retries or not self.retryable(result):
+                return result
+
+            delay = self.retry_delay(result, attempt)
+            log('WARN: %s returned status code %d, retrying in %.1fs\n' % (description, result.status_code, delay))
+            time.sleep(delay)
+            attempt += 1
+
+
+def report_metrics(metrics, profile, metrics_file):
+    """
+    prints the `metrics` of each domain as a table if `profile` is set, and writes them as JSON to `metrics_file`.
+    """
+    if profile:
+        for domain_name in sorted(metrics):
+            log('INFO: metrics for domain "%s" in %.3fs\n' % (domain_name, metrics[domain_name].as_dict()['seconds']))
+            log(metrics[domain_name].summary())
+
+    if metrics_file:
+        with open(metrics_file, 'w') as file_ptr:
+            json.dump({'domains': {domain_name: m.as_dict() for domain_name, m in metrics.items()}},
+                      file_ptr, indent=2, sort_keys=True)
 
 
 class MarathonDeployer:
 
-    def __init__(self, domain_name, dry_run=False, verbose=False, verify_ssl=True):
+    def __init__(self, domain_name, dry_run=False, verbose=False, verify_ssl=True,
+                 bulk_fetch_threshold=10, parallelism=1, template_cache_dir=None,
+                 render_cache_dir=None, render_workers=1, snapshot_cache_dir=None,
+                 batch_size=0, wait_timeout=None, write_workers=1, max_retries=5, index_dir=None):
+        self.metrics = Metrics()
         self.dry_run = dry_run
         self.verbose = verbose
         self.headers = {}
         self.domain_name = domain_name
-        self.read_domain_cfg()
+        self.domain_layers = None
+        self.domain_items = None
+        self.app_items = {}
+        with self.metrics.phase('load'):
+            self.read_domain_cfg()
         self.read_authorization_header()
         self.application_definitions = {}
         self.verify_ssl = verify_ssl
+        self.bulk_fetch_threshold = bulk_fetch_threshold
+        self.parallelism = max(parallelism, 1)
+        self.template_cache_dir = template_cache_dir
+        self.render_cache_dir = render_cache_dir
+        self.render_cache = None
+        self.render_workers = max(render_workers, 1)
+        self._session = None
+        self.snapshot_cache_dir = snapshot_cache_dir
+        self.batch_size = batch_size
+        self.batch = []
+        self.batch_lock = threading.Lock()
+        self.wait_timeout = wait_timeout
+        self.wait_deadline = None
+        self.deployments = {}
+        self.deployment_lock = threading.Lock()
+        self.event_stream = None
+        self.deployment_events = None
+        self.deployed_versions = {}
+        self.scheduler = WriteScheduler(self.parallelism, max_retries=max_retries)
+        self.leader_url = None
+        self.failed_masters = set()
+        self.leader_lock = threading.Lock()
+        self.write_workers = max(write_workers, 1)
+        self.index_dir = index_dir
+        self.plan = None
+        self.plan_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """
+        the keep-alive HTTP session shared by all requests to Marathon, created on first use.
+        """
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=max(self.parallelism, 10))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self._session = session
+        return self._session
 
     def is_empty_value(self, value):
         if value is None:
@@ -79,30 +746,56 @@ class MarathonDeployer:
         """
         returns the configuration from ./cfg/domain.cfg'
         """
+        import configparser
         try:
-            cdir = os.path.abspath(os.path.join('.', 'cfg'))
+            if self.domain_layers is None:
+                cdir = os.path.abspath(os.path.join('.', 'cfg'))
+                self.domain_layers = read_config_layers(os.path.join(cdir, 'domain.cfg'))
+
             config = configparser.ConfigParser(
                 {'domain_name': self.domain_name})
-            config.read(os.path.join(cdir, 'domain.cfg'))
+            # only the DEFAULT and domain sections contribute to the properties of the domain
+            config.read_dict({section: self.domain_layers[section]
+                              for section in ('DEFAULT', self.domain_name) if section in self.domain_layers})
 
             if not config.has_section(self.domain_name):
-                sys.stderr.write(
+                log(
                     'ERROR: the domain "%s" does not exist in cfg/domain.cfg\n' % self.domain_name)
                 sys.exit(1)
 
             self.marathon_url = config.get(self.domain_name, 'marathon_url')
             if self.marathon_url is None:
-                sys.stderr.write(
+                log(
                     'ERROR: No marathon_url has been defined for domain "%s" in cfg/domain.cfg\n'
                     % self.domain_name)
                 sys.exit(1)
         except configparser.Error as e:
-            sys.stderr.write(
+            log(
                 'ERROR: failed to read domain configuration ./cfg/domain.cfg, %s\n' % e)
             sys.exit(1)
 
         return config
 
+    def read_app_cfg(self, cfg_file):
+        """
+        returns the properties of the domain, with the application configuration `cfg_file`
+        overlayed on the domain configuration. The properties are only interpolated again
+        when the application configuration file has changed.
+        """
+        with self.metrics.phase('load'):
+            if not os.path.isfile(cfg_file):
+                if self.domain_items is None:
+                    self.domain_items = dict(self.read_domain_cfg().items(self.domain_name))
+                return self.domain_items
+
+            stat = os.stat(cfg_file)
+            key = (cfg_file, stat.st_mtime, stat.st_size)
+            if key not in self.app_items:
+                config = self.read_domain_cfg()
+                config.read(cfg_file)
+                self.app_items[key] = dict(config.items(self.domain_name))
+            return self.app_items[key]
+
     def read_authorization_header(self):
         """
         reads id_token from the file ~/.auth_token and returns
@@ -116,190 +809,1290 @@ class MarathonDeployer:
                     bearer_token = json.load(file_ptr)['id_token']
                 self.headers['Authorization'] = 'Bearer %s' % bearer_token
             except Exception as e:
-                sys.stderr.write(
+                log(
                     'could not read token from %s: %s\n' % (filename, e))
                 sys.exit(1)
 
-    def load_application_definition(self, path):
+    def get_jinja_environment(self, directory):
+        return get_jinja_environment(directory, self.template_cache_dir)
+
+    def render_fingerprint(self, path, cfg_file):
+        """
+        returns a fingerprint of all inputs of the rendering of template `path`: the template, the
+        application configuration `cfg_file`, the domain configuration and the domain name.
+        """
+        fingerprint = hashlib.sha1()
+        for filename in [path, cfg_file]:
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as file_ptr:
+                    fingerprint.update(file_ptr.read())
+            fingerprint.update(b'\0')
+        domain = [self.domain_layers.get('DEFAULT'), self.domain_layers.get(self.domain_name), self.domain_name]
+        fingerprint.update(json.dumps(domain, sort_keys=True).encode('utf-8'))
+        return fingerprint.hexdigest()
+
+    def read_render_cache(self):
+        """
+        reads the rendered application definitions of the domain from the `render_cache_dir`.
+        """
+        self.render_cache = {}
+        filename = os.path.join(self.render_cache_dir, '%s.json' % self.domain_name)
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as file_ptr:
+                    self.render_cache = json.load(file_ptr)
+            except ValueError as e:
+                log('WARN: ignoring invalid render cache %s, %s\n' % (filename, e))
+
+    def write_render_cache(self):
         """
-        generates application definitions for a specific environment.
+        writes the rendered application definitions of the domain to the `render_cache_dir`.
+        """
+        if self.render_cache is None:
+            return
+        if not os.path.exists(self.render_cache_dir):
+            os.makedirs(self.render_cache_dir)
+        filename = os.path.join(self.render_cache_dir, '%s.json' % self.domain_name)
+        with self.metrics.phase('write'):
+            with open(filename + '.tmp', 'w') as file_ptr:
+                json.dump(self.render_cache, file_ptr)
+            os.rename(filename + '.tmp', filename)
+
+    def get_cached_application_definition(self, path, fingerprint):
+        """
+        returns the application definition rendered from `path` by a previous run, or None
+        if any of its inputs has changed.
+        """
+        if self.render_cache is None:
+            self.read_render_cache()
+        cached = self.render_cache.get(os.path.abspath(path))
+        if cached is not None and cached['fingerprint'] == fingerprint:
+            return json.loads(json.dumps(cached['app']))
+        return None
+
+    def cache_application_definition(self, path, fingerprint, app):
+        self.render_cache[os.path.abspath(path)] = {'fingerprint': fingerprint, 'app': app}
+        return json.loads(json.dumps(app))
+
+    def render_application_definition(self, path):
+        """
+        renders the application definition template `path` for the domain, or raises
+        a RenderError if the configuration or the template is invalid.
         """
         app_id = os.path.splitext(os.path.basename(path))[0]
         cfg_file = os.path.join(os.path.dirname(path), '%s.cfg' % app_id)
 
+        import configparser
         try:
-            config = self.read_domain_cfg()
-            config.read(cfg_file)
-            items = dict(config.items(self.domain_name)) if config.has_section(
-                self.domain_name) else config.defaults()
+            items = self.read_app_cfg(cfg_file)
         except configparser.Error as e:
-            sys.stderr.write(
-                'ERROR: failed to read  configuration %s, %s\n' % (cfg_file, e))
-            sys.exit(1)
+            raise RenderError(
+                'failed to read  configuration %s, %s' % (cfg_file, e))
 
         try:
-            jinja = Environment(
-                autoescape=False,
-                loader=FileSystemLoader(os.path.dirname(path)),
-                trim_blocks=False)
+            jinja = self.get_jinja_environment(os.path.dirname(path))
             filename = os.path.basename(path)
             rendered_app_def = jinja.get_template(filename).render(items)
             app = json.loads(rendered_app_def)
 
             if app['id'] != '/%s' % app_id:
-                sys.stderr.write(
-                    'ERROR: application id in template "%s" is not "/%s"\n' % (path, app_id))
-                sys.exit(1)
+                raise RenderError(
+                    'application id in template "%s" is not "/%s"' % (path, app_id))
 
+        except RenderError:
+            raise
         except Exception as error:
-            sys.stderr.write(
-                'ERROR: invalidate template %s, %s\n' % (path, error))
+            raise RenderError(
+                'invalidate template %s, %s' % (path, error))
+
+        return app
+
+    def load_application_definition(self, path):
+        """
+        generates application definitions for a specific environment. If a `render_cache_dir`
+        is set, the template is only rendered when one of its inputs has changed.
+        """
+        app_id = os.path.splitext(os.path.basename(path))[0]
+        if self.render_cache_dir is not None:
+            fingerprint = self.render_fingerprint(path, os.path.join(os.path.dirname(path), '%s.cfg' % app_id))
+            app = self.get_cached_application_definition(path, fingerprint)
+            if app is not None:
+                return app
+
+        try:
+            with self.metrics.phase('render', '/%s' % app_id):
+                app = self.render_application_definition(path)
+        except RenderError as error:
+            log('ERROR: %s\n' % error)
             sys.exit(1)
 
+        if self.render_cache_dir is not None:
+            app = self.cache_application_definition(path, fingerprint, app)
         return app
 
+    def load_application_definitions(self, paths):
+        """
+        generates the application definitions of all templates in `paths`. With more than one
+        `render_workers`, the templates are rendered by a pool of processes and all errors are
+        reported before exiting.
+        """
+        if self.render_workers == 1 or len(paths) < 2:
+            return [self.load_application_definition(path) for path in paths]
+
+        apps = [None] * len(paths)
+        fingerprints = {}
+        for i, path in enumerate(paths):
+            if self.render_cache_dir is not None:
+                app_id = os.path.splitext(os.path.basename(path))[0]
+                fingerprints[i] = self.render_fingerprint(
+                    path, os.path.join(os.path.dirname(path), '%s.cfg' % app_id))
+                apps[i] = self.get_cached_application_definition(path, fingerprints[i])
+
+        pending = [i for i, app in enumerate(apps) if app is None]
+        if len(pending) == 0:
+            return apps
+
+        import multiprocessing
+        pool = multiprocessing.Pool(min(self.render_workers, len(pending)),
+                                    initializer=_init_render_worker,
+                                    initargs=(self.domain_name, self.domain_layers, self.template_cache_dir))
+        try:
+            with self.metrics.phase('render'):
+                results = pool.map(_render_worker, [paths[i] for i in pending],
+                                   chunksize=max(1, len(pending) // (self.render_workers * 4)))
+        finally:
+            pool.terminate()
+
+        errors = []
+        for i, (app, error) in zip(pending, results):
+            if error is not None:
+                errors.append(error)
+            elif self.render_cache_dir is not None:
+                apps[i] = self.cache_application_definition(paths[i], fingerprints[i], app)
+            else:
+                apps[i] = app
+
+        if len(errors) > 0:
+            for error in errors:
+                log('ERROR: %s\n' % error)
+            sys.exit(1)
+
+        return apps
+
     def load_all_app_definitions(self, directory=os.path.join('.', 'apps')):
         """
         load all files with the suffix `.json` from the `directory` as application definition.
         """
         result = {}
+        paths = []
         app_files = fnmatch.filter(os.listdir(directory), '*.json')
         for filename in app_files:
             path = os.path.join(directory, filename)
             if os.path.isfile(path):
-                app = self.load_application_definition(path)
-                if app['id'] not in result:
-                    result[app['id']] = app
-                else:
-                    sys.stderr.write(
-                        'ERROR: skipping "%s" as it contains a duplicate app definition "%s"\n'
-                        % (path, app['id']))
+                paths.append(path)
             else:
-                sys.stderr.write(
+                log(
                     'WARN: skipping "%s" as it is not a file\n' % path)
+
+        for path, app in zip(paths, self.load_application_definitions(paths)):
+            if app['id'] not in result:
+                result[app['id']] = app
+            else:
+                log(
+                    'ERROR: skipping "%s" as it contains a duplicate app definition "%s"\n'
+                    % (path, app['id']))
+
+        if self.render_cache is not None:
+            paths = set(os.path.abspath(path) for path in paths)
+            for path in list(self.render_cache.keys()):
+                if os.path.dirname(path) == os.path.abspath(directory) and path not in paths:
+                    del self.render_cache[path]
+            self.write_render_cache()
         return result
 
+    def load_app_definitions(self, app_ids, directory=os.path.join('.', 'apps')):
+        """
+        load the application definitions of `app_ids` from the `directory`, without rendering
+        any of the other templates. Application ids without a template are skipped.
+        """
+        paths = {}
+        for app_id in app_ids:
+            path = os.path.join(directory, '%s.json' % app_id.lstrip('/'))
+            if os.path.isfile(path):
+                paths[app_id] = path
+
+        ids = list(paths.keys())
+        result = dict(zip(ids, self.load_application_definitions([paths[app_id] for app_id in ids])))
+
+        self.write_render_cache()
+        return result
+
+    def template_paths(self, directory=os.path.join('.', 'apps')):
+        """
+        returns the application ids of the templates in `directory`, mapped to their paths.
+        """
+        return {'/%s' % os.path.splitext(filename)[0]: os.path.join(directory, filename)
+                for filename in fnmatch.filter(os.listdir(directory), '*.json')
+                if os.path.isfile(os.path.join(directory, filename))}
+
+    def update_index(self, directory=os.path.join('.', 'apps')):
+        """
+        returns the index of the templates in `directory` for the domain, which maps each application id to
+        the template path, the labels of the application and the fingerprint of the inputs of its rendering,
+        and the application definitions which had to be rendered to bring it up to date. Only the templates
+        of which an input changed since the index was written are rendered.
+        """
+        filename = os.path.join(self.index_dir, '%s.json' % self.domain_name)
+        index = {}
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as file_ptr:
+                    index = json.load(file_ptr)
+            except ValueError as e:
+                log('WARN: ignoring invalid index %s, %s\n' % (filename, e))
+
+        paths = self.template_paths(directory)
+        fingerprints = {}
+        for app_id, path in paths.items():
+            fingerprints[app_id] = self.render_fingerprint(
+                path, os.path.join(directory, '%s.cfg' % app_id.lstrip('/')))
+        stale = sorted(app_id for app_id in paths if app_id not in index or
+                       index[app_id]['fingerprint'] != fingerprints[app_id] or index[app_id]['path'] != paths[app_id])
+
+        rendered = self.load_app_definitions(stale, directory) if len(stale) > 0 else {}
+        updated = {}
+        for app_id, path in paths.items():
+            if app_id in rendered:
+                updated[app_id] = {'path': path, 'fingerprint': fingerprints[app_id],
+                                   'labels': rendered[app_id].get('labels') or {}}
+            else:
+                updated[app_id] = index[app_id]
+
+        if updated != index:
+            if not os.path.exists(self.index_dir):
+                os.makedirs(self.index_dir)
+            with self.metrics.phase('write'):
+                with open(filename + '.tmp', 'w') as file_ptr:
+                    json.dump(updated, file_ptr)
+                os.rename(filename + '.tmp', filename)
+        return updated, rendered
+
+    def select_app_definitions(self, selectors, directory=os.path.join('.', 'apps')):
+        """
+        returns the application definitions in `directory` matching any of the `selectors`, rendering only the
+        matching templates. Labels are looked up in the index, which is brought up to date first.
+        """
+        selectors = [parse_selector(selector) for selector in selectors]
+        if any(kind != 'id' for terms in selectors for kind, _, _ in terms):
+            index, rendered = self.update_index(directory)
+        else:
+            index = {app_id: {'path': path, 'labels': {}} for app_id, path in self.template_paths(directory).items()}
+            rendered = {}
+
+        selected = [app_id for app_id, entry in index.items()
+                    if any(match_selector(terms, app_id, entry['labels']) for terms in selectors)]
+        apps = {app_id: rendered[app_id] for app_id in selected if app_id in rendered}
+        apps.update(self.load_app_definitions([app_id for app_id in selected if app_id not in rendered], directory))
+        return apps
+
+    def request(self, method, path, **kwargs):
+        """
+        sends a request to Marathon over the shared, keep-alive session, and records its latency and
+        size in the metrics. The size of a streamed response is only known once it has been read.
+        """
+        headers = dict(self.headers, **kwargs.pop('headers', {}))
+        masters = self.marathon_masters()
+        if len(masters) == 1:
+            return self.send_request(method, self.marathon_url, path, headers=headers, **kwargs)
+
+        import requests
+        for attempt in range(len(masters) + 1):
+            url = self.get_leader_url(masters)
+            try:
+                result = self.send_request(method, url, path, headers=headers, allow_redirects=False, **kwargs)
+            except requests.ConnectionError as error:
+                if attempt == len(masters):
+                    raise
+                log('WARN: Marathon master %s is not available, %s\n' % (url, error))
+                self.reset_leader(url, failed=True)
+                continue
+
+            if not result.is_redirect or attempt == len(masters):
+                return result
+            result.close()
+            log('INFO: Marathon master %s is no longer the leader\n' % url)
+            self.reset_leader(url)
+
+    def write(self, method, path, **kwargs):
+        """
+        sends a request changing Marathon through the write scheduler, which retries it while Marathon is busy.
+        """
+        return self.scheduler.execute('%s %s' % (method, path), lambda: self.request(method, path, **kwargs))
+
+    def send_request(self, method, url, path, **kwargs):
+        """
+        sends a request to the Marathon master at `url`, and records its latency and size in the
+        metrics. The size of a streamed response is only known once it has been read.
+        """
+        start = time.time()
+        try:
+            result = self.session.request(method, url + path, verify=self.verify_ssl, **kwargs)
+        except Exception:
+            self.metrics.record_request(method, path, time.time() - start)
+            raise
+
+        body = result.request.body
+        received = 0 if kwargs.get('stream') else getattr(result.raw, 'tell', lambda: len(result.content))()
+        self.metrics.record_request(method, path, time.time() - start, result.status_code,
+                                    len(body) if body else 0, received)
+        return result
+
+    def marathon_masters(self):
+        """
+        returns the urls of the Marathon masters, listed in `marathon_url` separated by commas or spaces.
+        """
+        return [url.rstrip('/') for url in re.split(r'[\s,]+', self.marathon_url) if url]
+
+    def get_leader_url(self, masters):
+        """
+        returns the url of the leading Marathon master, asking the available `masters` in turn
+        for the leader if it is not known yet.
+        """
+        with self.leader_lock:
+            if self.leader_url is None:
+                self.leader_url = self.discover_leader(masters)
+            return self.leader_url
+
+    def reset_leader(self, url, failed=False):
+        """
+        forgets the leader, if it is still `url`, so that it is discovered again by the next request.
+        """
+        with self.leader_lock:
+            if failed:
+                self.failed_masters.add(url)
+            if self.leader_url == url:
+                self.leader_url = None
+
+    def discover_leader(self, masters):
+        """
+        returns the url of the leader reported by /v2/leader of the first available master of `masters`,
+        trying the masters which failed before last.
+        """
+        import requests
+        try:
+            from urlparse import urlparse
+        except ImportError:
+            from urllib.parse import urlparse
+
+        for master in sorted(masters, key=lambda url: url in self.failed_masters):
+            try:
+                result = self.send_request('GET', master, '/v2/leader', headers=self.headers, timeout=10)
+            except requests.RequestException as error:
+                log('WARN: Marathon master %s is not available, %s\n' % (master, error))
+                self.failed_masters.add(master)
+                continue
+
+            leader = result.json().get('leader') if result.status_code == 200 else None
+            if leader is None:
+                continue
+
+            self.failed_masters.discard(master)
+            for url in masters:
+                if urlparse(url).netloc == leader:
+                    return url
+            return '%s://%s' % (urlparse(master).scheme, leader)
+
+        log('ERROR: none of the Marathon masters %s reports a leader\n' % ', '.join(masters))
+        sys.exit(1)
+
+    def record_deployment(self, result, app_ids):
+        """
+        records the deployment started for the applications `app_ids`, as returned in the Marathon
+        response `result`. Nothing is recorded when the deployments are not waited for.
+        """
+        if self.wait_timeout is None:
+            return
+        try:
+            body = result.json()
+        except ValueError:
+            return
+        if not isinstance(body, dict):
+            return
+
+        if 'deploymentId' in body:
+            deployment_ids = [body['deploymentId']]
+        else:
+            deployment_ids = [deployment['id'] for deployment in body.get('deployments') or [] if 'id' in deployment]
+
+        with self.deployment_lock:
+            for deployment_id in deployment_ids:
+                self.deployments[deployment_id] = app_ids
+
+    def finish_deployment(self, pending, deployment_id, failed=False):
+        app_ids = pending.pop(deployment_id)
+        for app_id in app_ids:
+            if failed:
+                log('ERROR: deployment %s of application "%s" failed\n' % (deployment_id, app_id))
+            else:
+                log('INFO: deployment %s of application "%s" finished\n' % (deployment_id, app_id))
+
+    def poll_deployments(self, pending, once=False):
+        """
+        removes the deployments which are no longer running from `pending`, polling /v2/deployments
+        with an increasing interval until none are pending or the wait deadline has passed.
+        """
+        interval = 0.5
+        while len(pending) > 0:
+            result = self.request('GET', '/v2/deployments')
+            if result.status_code == 200:
+                running = set(deployment['id'] for deployment in result.json())
+                for deployment_id in [d for d in pending if d not in running]:
+                    self.finish_deployment(pending, deployment_id)
+
+            remaining = self.wait_deadline - time.time()
+            if once or len(pending) == 0 or remaining <= 0:
+                return
+            time.sleep(min(interval, remaining))
+            interval = min(interval * 2, 10)
+
+    def subscribe_deployment_events(self):
+        """
+        subscribes to the deployment events on the Marathon event stream, once per run. The events are read
+        into the queue `deployment_events` by a background thread. returns False if the stream is not available.
+        """
+        if self.event_stream is not None:
+            return self.deployment_events is not None
+
+        import requests
+        try:
+            from Queue import Queue
+        except ImportError:
+            from queue import Queue
+
+        event_types = [('event_type', 'deployment_success'), ('event_type', 'deployment_failed')]
+        try:
+            response = self.request('GET', '/v2/events', params=event_types, stream=True,
+                                    headers={'Accept': 'text/event-stream'}, timeout=(10, None))
+        except requests.RequestException:
+            self.event_stream = False
+            return False
+
+        self.event_stream = response
+        if response.status_code != 200 or \
+                not response.headers.get('Content-Type', '').startswith('text/event-stream'):
+            response.close()
+            return False
+
+        events = self.deployment_events = Queue()
+
+        def read():
+            try:
+                for event in iter_server_sent_events(response.iter_lines(chunk_size=1)):
+                    events.put(event)
+            except Exception:
+                # the stream broke or was closed by close_deployment_events
+                pass
+            finally:
+                events.put(None)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+        return True
+
+    def close_deployment_events(self):
+        if self.event_stream:
+            self.event_stream.close()
+        self.event_stream, self.deployment_events = None, None
+
+    def follow_deployment_events(self, pending):
+        """
+        removes the deployments from `pending` as Marathon reports them finished on the event stream,
+        until none are pending or the wait deadline has passed. returns the ids of the failed deployments,
+        or None if the event stream is not available.
+        """
+        try:
+            from Queue import Empty
+        except ImportError:
+            from queue import Empty
+
+        subscribed = self.event_stream is None
+        if not self.subscribe_deployment_events():
+            return None
+        if subscribed:
+            # deployments which finished before the subscription will not be reported on the stream
+            self.poll_deployments(pending, once=True)
+
+        failed = []
+        while len(pending) > 0:
+            remaining = self.wait_deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                event = self.deployment_events.get(timeout=remaining)
+            except Empty:
+                break
+            if event is None:
+                # the stream has ended, the next waves are polled
+                self.deployment_events = None
+                break
+            if event.get('id') in pending and \
+                    event.get('eventType') in ('deployment_success', 'deployment_failed'):
+                if event['eventType'] == 'deployment_failed':
+                    failed.append(event['id'])
+                self.finish_deployment(pending, event['id'], event['eventType'] == 'deployment_failed')
+
+        if len(pending) > 0 and time.time() < self.wait_deadline:
+            self.poll_deployments(pending)
+        return failed
+
+    def wait_for_deployments(self):
+        """
+        waits until all deployments started by this run have finished, following the Marathon event stream
+        or, if that is not available, polling /v2/deployments. returns True if all deployments finished
+        successfully within the `wait_timeout`.
+        """
+        with self.deployment_lock:
+            pending, self.deployments = self.deployments, {}
+        if len(pending) == 0:
+            return True
+
+        if self.wait_deadline is None:
+            self.wait_deadline = time.time() + self.wait_timeout
+
+        failed = self.follow_deployment_events(pending)
+        if failed is None:
+            log('WARN: the Marathon event stream is not available, polling the deployments\n')
+            failed = []
+            self.poll_deployments(pending)
+
+        for deployment_id in sorted(pending):
+            for app_id in pending[deployment_id]:
+                log('ERROR: timed out waiting for deployment %s of application "%s"\n' % (deployment_id, app_id))
+        return len(failed) == 0 and len(pending) == 0
+
+    def run_parallel(self, function, items):
+        """
+        calls `function` for each of the `items` on a pool of `parallelism` threads. The
+        output of each call is buffered and written in the order of the items.
+        """
+        run_parallel(function, items, self.parallelism)
+
     def delete_application(self, app_id):
-        sys.stderr.write(
+        """
+        deletes the application `app_id`, and returns True if Marathon accepted the delete.
+        """
+        log(
             'INFO: deleting application "%s"\n' % app_id)
         if self.dry_run:
-            return
+            return True
 
-        result = requests.delete('%s/v2/apps/%s' % (self.marathon_url, app_id),
-                                 headers=self.headers, verify=self.verify_ssl)
+        with self.metrics.phase('apply', app_id):
+            result = self.write('DELETE', '/v2/apps/%s' % app_id)
         if result.status_code == 200 or result.status_code == 201:
-            sys.stderr.write(
+            self.record_deployment(result, [app_id])
+            log(
                 'INFO: delete running for application "%s"\n' % app_id)
+            return True
         else:
-            sys.stderr.write(
+            log(
                 'ERROR: deployment for application "%s" failed, with status code %d\n'
                 % (app_id, result.status_code))
+            return False
+
+    def delete_group(self, group_id, app_ids):
+        """
+        deletes the group `group_id` with its applications `app_ids`, and returns True if Marathon accepted the delete.
+        """
+        log('INFO: deleting group "%s" with %d applications\n' % (group_id, len(app_ids)))
+        if self.dry_run:
+            return True
+
+        with self.metrics.phase('apply'):
+            result = self.write('DELETE', '/v2/groups/%s' % group_id)
+        if result.status_code == 200 or result.status_code == 201:
+            self.record_deployment(result, app_ids)
+            log('INFO: delete running for group "%s"\n' % group_id)
+            return True
+        else:
+            log('ERROR: deployment for group "%s" failed, with status code %d\n' % (group_id, result.status_code))
+            return False
+
+    def list_deployed_applications(self):
+        """
+        returns the ids of the deployed applications mapped to their labels, and records their versions. The full
+        application definitions are streamed, unless a snapshot cache is used, but only these fields are kept.
+        """
+        if self.snapshot_cache_dir is not None:
+            return {app_id: app.get('labels') or {} for app_id, app in self.get_all_applications().items()}
+
+        apps = {}
+        for app in self.iter_all_applications():
+            apps[app['id']] = app.get('labels') or {}
+            self.deployed_versions[app['id']] = app.get('version')
+        return apps
+
+    def undefined_groups(self, undefined_app_ids):
+        """
+        returns the outermost groups of which all applications are among `undefined_app_ids` and which hold no
+        pods, mapped to the ids of their applications. The applications of a group are taken from the same
+        response as the group itself, so that an application deployed since the listing keeps its group. No
+        groups are returned if Marathon does not report its groups.
+        """
+        with self.metrics.phase('fetch'):
+            result = self.request('GET', '/v2/groups',
+                                  params=[('embed', 'group.groups'), ('embed', 'group.apps'), ('embed', 'group.pods')])
+        if result.status_code != 200:
+            return {}
+
+        members, has_pods = {}, {}
+
+        def collect(group):
+            app_ids = [app['id'] for app in group.get('apps') or []]
+            pods = len(group.get('pods') or []) > 0
+            for subgroup in group.get('groups') or []:
+                collect(subgroup)
+                app_ids.extend(members[subgroup['id']])
+                pods = pods or has_pods[subgroup['id']]
+            members[group['id']], has_pods[group['id']] = app_ids, pods
+
+        groups = {}
+
+        def visit(group):
+            group_id = group['id']
+            app_ids = members[group_id]
+            if group_id != '/' and len(app_ids) > 0 and not has_pods[group_id] and \
+                    all(app_id in undefined_app_ids for app_id in app_ids):
+                groups[group_id] = sorted(app_ids)
+                return
+            for subgroup in group.get('groups') or []:
+                visit(subgroup)
+
+        root = result.json()
+        collect(root)
+        visit(root)
+        return groups
+
+    def prune_applications(self, defined_app_ids, selectors=None):
+        """
+        deletes the deployed applications which are not among the `defined_app_ids` and match any of the parsed
+        `selectors`. Undefined applications making up a whole group are deleted with a single request for the
+        group, the others concurrently. Reports the number of deleted applications and the time taken.
+        """
+        start = time.time()
+        deployed_apps = self.list_deployed_applications()
+        undefined_apps = set(deployed_apps).difference(set(defined_app_ids))
+        if selectors:
+            undefined_apps = set(app_id for app_id in undefined_apps
+                                 if any(match_selector(terms, app_id, deployed_apps[app_id]) for terms in selectors))
+
+        groups = self.undefined_groups(undefined_apps) if len(undefined_apps) > 1 else {}
+        in_groups = set(app_id for app_ids in groups.values() for app_id in app_ids)
+        deletes = [(group_id, groups[group_id]) for group_id in sorted(groups)] + \
+            [(None, [app_id]) for app_id in sorted(undefined_apps - in_groups)]
+
+        failed = []
+
+        def delete(item):
+            group_id, app_ids = item
+            deleted = self.delete_group(group_id, app_ids) if group_id else self.delete_application(app_ids[0])
+            if not deleted:
+                failed.extend(app_ids)
+
+        self.run_parallel(delete, deletes)
+        log('INFO: %s %d applications, %d of them in %d groups, in %.1fs\n' % (
+            'would delete' if self.dry_run else 'deleted', len(undefined_apps) - len(failed), len(in_groups),
+            len(groups), time.time() - start))
+        if len(failed) > 0:
+            log('ERROR: failed to delete %d applications\n' % len(failed))
 
     def deploy_new_application(self, app):
         app_id = app['id']
-        sys.stderr.write(
+        log(
             'INFO: deploying new application "%s"\n' % app_id)
+        if self.plan is not None:
+            self.plan_operation('create', app)
         if self.dry_run:
             return
 
-        result = requests.post(self.marathon_url + "/v2/apps",
-                               json=app, headers=self.headers, verify=self.verify_ssl)
+        if self.batch_size > 0:
+            self.queue_application(app)
+            return
+
+        with self.metrics.phase('apply', app_id):
+            result = self.write('POST', '/v2/apps', json=app)
         if result.status_code == 200 or result.status_code == 201:
-            sys.stderr.write(
+            self.record_deployment(result, [app_id])
+            log(
                 'INFO: deployment running for application "%s"\n' % app_id)
         else:
-            sys.stderr.write(
+            log(
                 'ERROR: deployment for application "%s" failed, with status code %d\n'
                 % (app_id, result.status_code))
 
+    def queue_application(self, app):
+        """
+        queues the application `app` to be created or updated by `apply_batch`.
+        """
+        with self.batch_lock:
+            self.batch.append(app)
+
+    def apply_batch(self, order=None):
+        """
+        creates or updates all queued applications with chunks of `batch_size` applications
+        per PUT /v2/apps request, each of which starts a single Marathon deployment. The
+        applications are sent in the `order` of their ids, if specified.
+        """
+        with self.batch_lock:
+            pending, self.batch = self.batch, []
+        if len(pending) == 0:
+            return
+        if order is not None:
+            position = {app_id: i for i, app_id in enumerate(order)}
+            pending.sort(key=lambda app: position.get(app['id'], len(position)))
+
+        for start in range(0, len(pending), self.batch_size):
+            chunk = pending[start:start + self.batch_size]
+            with self.metrics.phase('apply'):
+                result = self.write('PUT', '/v2/apps', json=chunk)
+            if result.status_code == 200 or result.status_code == 201:
+                self.record_deployment(result, [app['id'] for app in chunk])
+                deployment_id = result.json().get('deploymentId')
+                for app in chunk:
+                    log(
+                        'INFO: deployment %s running for application "%s"\n' % (deployment_id, app['id']))
+            else:
+                for app in chunk:
+                    log(
+                        'ERROR: deployment for application "%s" failed, with status code %d\n'
+                        % (app['id'], result.status_code))
+
     def get_application(self, app_id):
-        result = requests.get(self.marathon_url + "/v2/apps/%s" %
-                              app_id, headers=self.headers, verify=self.verify_ssl)
+        """
+        retrieves the cleaned application definition of `app_id`, or None if it is not deployed.
+        """
+        with self.metrics.phase('fetch', app_id):
+            result = self.request('GET', '/v2/apps/%s' % app_id)
+
         if result.status_code == 200:
             app = result.json()['app']
+            self.deployed_versions[app_id] = app.get('version')
             self.clean_app(app)
         elif result.status_code == 404:
+            self.deployed_versions[app_id] = None
             app = None
         else:
-            sys.stderr.write(
+            log(
                 'ERROR: could not retrieve application "%s", received status code %d from %s\n'
                 % (app_id, result.status_code, self.marathon_url))
             sys.exit(1)
         return app
 
+    def normalize_app(self, app):
+        """
+        returns a cleaned copy of the application definition `app`, with the Marathon defaults
+        for missing fields and whole numbers in a single representation.
+        """
+        def canonical(value):
+            if isinstance(value, dict):
+                return {k: canonical(v) for k, v in value.items()}
+            elif isinstance(value, list):
+                return [canonical(v) for v in value]
+            elif isinstance(value, float) and value.is_integer():
+                return int(value)
+            return value
+
+        normalized = canonical(app)
+        self.clean_app(normalized)
+        for field, value in MARATHON_DEFAULTS.items():
+            if field not in normalized:
+                normalized[field] = canonical(value)
+        return normalized
+
+    def fingerprint_app(self, app):
+        """
+        returns a hash of the canonical JSON serialization of the normalized application definition `app`.
+        """
+        canonical = json.dumps(app, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
     def update_application(self, app, existing_app):
         app_id = app['id']
-        self.clean_app(existing_app)
-        differences = json.loads(
-            jdiff(existing_app, app, syntax='explicit', dump=True))
+        with self.metrics.phase('diff', app_id):
+            self.clean_app(existing_app)
+            defined_app = self.normalize_app(app)
+            deployed_app = self.normalize_app(existing_app)
 
-        if len(differences.keys()) == 0:
-            sys.stderr.write(
-                'INFO: no changes to application "%s"\n' % app_id)
-            return
-        else:
-            sys.stderr.write(
-                'INFO: updating application "%s"\n' % (app_id))
+            if self.fingerprint_app(defined_app) == self.fingerprint_app(deployed_app):
+                log(
+                    'INFO: no changes to application "%s"\n' % app_id)
+                return
+            else:
+                log(
+                    'INFO: updating application "%s"\n' % (app_id))
 
-        if self.verbose:
-            json.dump(differences, sys.stderr, indent=2)
-            sys.stderr.write('\n')
+            if self.verbose:
+                from jsondiff import diff as jdiff
+                differences = json.loads(
+                    jdiff(deployed_app, defined_app, syntax='explicit', dump=True))
+                log('%s\n' % json.dumps(differences, indent=2))
 
+        if self.plan is not None:
+            self.plan_operation('update', app)
         if self.dry_run:
             return
+        self.replace_application(app)
+
+    def replace_application(self, app):
+        """
+        replaces the deployed definition of the application `app`.
+        """
+        app_id = app['id']
+        if self.batch_size > 0:
+            self.queue_application(app)
+            return
 
-        result = requests.put(self.marathon_url + "/v2/apps/%s" % app_id,
-                              json=app,
-                              headers=self.headers, verify=self.verify_ssl)
+        with self.metrics.phase('apply', app_id):
+            result = self.write('PUT', '/v2/apps/%s' % app_id, json=app)
         if result.status_code == 200 or result.status_code == 201:
-            sys.stderr.write(
+            self.record_deployment(result, [app_id])
+            log(
                 'INFO: deployment running for application "%s"\n' % app_id)
         else:
-            sys.stderr.write(
+            log(
                 'ERROR: deployment for application "%s" failed, with status code %d\n' % (
                     app_id, result.status_code))
 
-    def deploy_application(self, app):
-        app_id = app['id']
-        existing_app = self.get_application(app_id)
+    def deploy_application(self, app, existing_app=None, fetch=True):
+        """
+        creates or updates the application `app`. The deployed application definition is
+        retrieved from Marathon, unless `fetch` is False and the `existing_app` is passed in.
+        """
+        if fetch:
+            existing_app = self.get_application(app['id'])
+
         if existing_app is not None:
             self.update_application(app, existing_app)
         else:
             self.deploy_new_application(app)
 
+    def deploy_applications(self, apps):
+        """
+        creates or updates all applications in the list `apps`. When more than
+        `bulk_fetch_threshold` applications are deployed or a snapshot cache is used, the
+        deployed state is retrieved in a single request instead of one request per application.
+
+        The applications are deployed in waves, ordered by their `dependencies`. The applications
+        of a single wave are deployed concurrently. With a `wait_timeout`, each wave is deployed
+        only after the deployments of the previous wave have finished.
+        """
+        try:
+            waves = dependency_waves(apps)
+        except ValueError as error:
+            log('ERROR: %s\n' % error)
+            sys.exit(1)
+
+        if len(apps) <= self.bulk_fetch_threshold and self.snapshot_cache_dir is None:
+            reconcile = self.deploy_application
+        else:
+            deployed_apps = self.get_all_applications()
+
+            def reconcile(app):
+                existing_app = deployed_apps.get(app['id'])
+                if existing_app is not None:
+                    self.clean_app(existing_app)
+                self.deploy_application(app, existing_app, fetch=False)
+
+        self.apply_waves(waves, reconcile)
+
+    def apply_waves(self, waves, function, key=lambda app: app['id']):
+        """
+        calls `function` concurrently for the items of each wave in `waves`, applies the queued
+        applications and, with a `wait_timeout`, waits for the deployments of the wave to finish.
+        """
+        try:
+            for wave in waves:
+                self.run_parallel(function, wave)
+                self.apply_batch([key(item) for item in wave])
+                if self.wait_timeout is None:
+                    continue
+                with self.metrics.phase('wait'):
+                    finished = self.wait_for_deployments()
+                if not finished:
+                    log('ERROR: not all deployments finished successfully\n')
+                    sys.exit(1)
+        finally:
+            self.close_deployment_events()
+
+    def reload_changed_definitions(self, paths, directory):
+        """
+        renders the templates in `directory` affected by the changed `paths` again, or all of them if the
+        domain configuration changed, and returns the ids of the affected applications.
+        """
+        directory = os.path.abspath(directory)
+        if os.path.abspath(os.path.join('.', 'cfg', 'domain.cfg')) in paths:
+            self.domain_layers, self.domain_items, self.app_items = None, None, {}
+            try:
+                self.read_domain_cfg()
+            except SystemExit:
+                return set()
+            templates = set(os.path.join(directory, filename)
+                            for filename in fnmatch.filter(os.listdir(directory), '*.json'))
+            templates.update(os.path.join(directory, '%s.json' % app_id.lstrip('/'))
+                             for app_id in self.application_definitions)
+        else:
+            templates = set(os.path.splitext(path)[0] + '.json' for path in paths
+                            if os.path.dirname(path) == directory and os.path.splitext(path)[1] in ('.json', '.cfg'))
+
+        affected = set()
+        for path in sorted(templates):
+            app_id = '/%s' % os.path.splitext(os.path.basename(path))[0]
+            affected.add(app_id)
+            if not os.path.isfile(path):
+                if self.application_definitions.pop(app_id, None) is not None:
+                    log('INFO: application "%s" is no longer defined\n' % app_id)
+                continue
+            try:
+                with self.metrics.phase('render', app_id):
+                    self.application_definitions[app_id] = self.render_application_definition(path)
+            except RenderError as error:
+                log('ERROR: %s\n' % error)
+        return affected
+
+    def reconcile_drift(self, app_ids, deployed_apps, reported):
+        """
+        reports or, if not a dry run, deploys the defined applications among `app_ids` which differ from the
+        `deployed_apps`. An application is only reported again when its definition or deployed state changes;
+        `reported` holds the fingerprints of the applications reported so far.
+        """
+        for app_id in sorted(app_ids):
+            app = self.application_definitions.get(app_id)
+            if app is None:
+                reported.pop(app_id, None)
+                continue
+
+            existing_app = deployed_apps.get(app_id)
+            with self.metrics.phase('diff', app_id):
+                fingerprint = self.fingerprint_app(self.normalize_app(app))
+                deployed = self.fingerprint_app(self.normalize_app(existing_app)) if existing_app is not None else None
+            if fingerprint == deployed:
+                if reported.pop(app_id, None) is not None:
+                    log('INFO: application "%s" is in sync\n' % app_id)
+                continue
+
+            if reported.get(app_id) != (fingerprint, deployed):
+                reported[app_id] = (fingerprint, deployed)
+                existing_app = json.loads(json.dumps(existing_app)) if existing_app is not None else None
+                self.deploy_application(json.loads(json.dumps(app)), existing_app, fetch=False)
+
+    def watch_applications(self, directory=os.path.join('.', 'apps'), interval=1.0, refresh_interval=30,
+                           polling=False, stop=None):
+        """
+        keeps the application definitions in `directory` and the deployed applications in memory, and
+        reconciles them until `stop` is set. A changed template or configuration file only renders the affected
+        applications again. The deployed applications are refreshed in the background every `refresh_interval`
+        seconds, but only retrieved when the version of the root group has changed.
+        """
+        stop = stop if stop is not None else threading.Event()
+        watcher = FileWatcher([directory, os.path.join('.', 'cfg')], interval=interval, polling=polling)
+        self.application_definitions = self.load_all_app_definitions(directory)
+        state = {'version': self.get_root_group_version(), 'apps': self.get_all_applications()}
+        refreshed = threading.Event()
+        lock = threading.Lock()
+
+        def refresh():
+            while not stop.wait(refresh_interval):
+                try:
+                    version = self.get_root_group_version()
+                    if version is not None and version == state['version']:
+                        continue
+                    apps = self.get_all_applications()
+                except (Exception, SystemExit) as error:
+                    log('WARN: failed to refresh the deployed applications, %s\n' % error)
+                    continue
+                with lock:
+                    state['version'], state['apps'] = version, apps
+                refreshed.set()
+
+        refresher = threading.Thread(target=refresh)
+        refresher.daemon = True
+        refresher.start()
+
+        reported = {}
+        log('INFO: watching %d applications in %s\n' % (len(self.application_definitions), directory))
+        try:
+            with lock:
+                deployed_apps = state['apps']
+            self.reconcile_drift(set(self.application_definitions), deployed_apps, reported)
+            while not stop.is_set():
+                changed = watcher.changes(interval)
+                if len(changed) > 0:
+                    self.reconcile_drift(self.reload_changed_definitions(changed, directory), deployed_apps, reported)
+                if refreshed.is_set():
+                    refreshed.clear()
+                    with lock:
+                        deployed_apps = state['apps']
+                    self.reconcile_drift(set(self.application_definitions), deployed_apps, reported)
+        finally:
+            stop.set()
+            watcher.close()
+
+    def plan_operation(self, action, app):
+        """
+        adds the `action` on the application `app` to the plan, with the deployed version it was computed against.
+        """
+        with self.plan_lock:
+            self.plan.append({'action': action, 'app': app, 'version': self.deployed_versions.get(app['id'])})
+
+    def plan_applications(self, apps):
+        """
+        returns the plan to create or update all applications in the list `apps`, as a dictionary with the
+        operations in the order of their dependency waves. Nothing is changed in Marathon.
+        """
+        dry_run, self.dry_run, self.plan = self.dry_run, True, []
+        try:
+            self.deploy_applications(apps)
+            operations = self.plan
+        finally:
+            self.dry_run, self.plan = dry_run, None
+
+        position = {}
+        for wave_number, wave in enumerate(dependency_waves(apps)):
+            for i, app in enumerate(wave):
+                position[app['id']] = (wave_number, i)
+        for operation in operations:
+            operation['wave'] = position[operation['app']['id']][0]
+        operations.sort(key=lambda operation: position[operation['app']['id']])
+        return {'domain_name': self.domain_name, 'marathon_url': self.marathon_url, 'operations': operations}
+
+    def check_plan(self, plan):
+        """
+        returns True if the applications in the `plan` are deployed at the versions the plan was
+        computed against, and reports each application that has changed since.
+        """
+        app_ids = [operation['app']['id'] for operation in plan['operations']]
+        if len(app_ids) > self.bulk_fetch_threshold:
+            self.get_all_applications()
+        else:
+            self.run_parallel(self.get_application, app_ids)
+
+        changed = 0
+        for operation in plan['operations']:
+            app_id = operation['app']['id']
+            if self.deployed_versions.get(app_id) != operation['version']:
+                changed += 1
+                log('ERROR: application "%s" has changed since the plan was made, deployed version %s, planned %s\n'
+                    % (app_id, self.deployed_versions.get(app_id), operation['version']))
+        return changed == 0
+
+    def apply_operation(self, operation):
+        app = operation['app']
+        if operation['action'] == 'create':
+            self.deploy_new_application(app)
+            return
+
+        log('INFO: updating application "%s"\n' % app['id'])
+        if not self.dry_run:
+            self.replace_application(app)
+
+    def apply_plan(self, plan):
+        """
+        applies the operations of the `plan`, in waves, after checking that none of the applications
+        has changed since the plan was made.
+        """
+        if plan['marathon_url'] != self.marathon_url:
+            log('ERROR: the plan is made for %s, not for %s\n' % (plan['marathon_url'], self.marathon_url))
+            sys.exit(1)
+        if not self.check_plan(plan):
+            sys.exit(1)
+
+        waves = {}
+        for operation in plan['operations']:
+            waves.setdefault(operation['wave'], []).append(operation)
+        self.apply_waves([waves[wave_number] for wave_number in sorted(waves)], self.apply_operation,
+                         key=lambda operation: operation['app']['id'])
+
+    def get_root_group_version(self):
+        """
+        returns the version of the root group of Marathon, which changes whenever any
+        application is changed, or None if it cannot be retrieved.
+        """
+        with self.metrics.phase('fetch'):
+            result = self.request('GET', '/v2/groups', params={'embed': 'group.groups'})
+        if result.status_code == 200:
+            return result.json().get('version')
+        return None
+
+    def read_snapshot(self):
+        """
+        reads the snapshot of the deployed applications of the domain from the `snapshot_cache_dir`.
+        """
+        filename = os.path.join(self.snapshot_cache_dir, '%s.json' % self.domain_name)
+        if os.path.isfile(filename):
+            try:
+                with open(filename, 'r') as file_ptr:
+                    return json.load(file_ptr)
+            except ValueError as e:
+                log('WARN: ignoring invalid snapshot %s, %s\n' % (filename, e))
+        return {}
+
+    def write_snapshot(self, version, apps):
+        """
+        writes the cleaned deployed applications `apps` of the root group `version` as the
+        snapshot of the domain, together with the version of each application.
+        """
+        if not os.path.exists(self.snapshot_cache_dir):
+            os.makedirs(self.snapshot_cache_dir)
+        snapshot = {'marathon_url': self.marathon_url, 'version': version, 'versions': {}, 'apps': {}}
+        for app_id, app in apps.items():
+            snapshot['versions'][app_id] = app.get('version')
+            snapshot['apps'][app_id] = json.loads(json.dumps(app))
+            self.clean_app(snapshot['apps'][app_id])
+
+        filename = os.path.join(self.snapshot_cache_dir, '%s.json' % self.domain_name)
+        with self.metrics.phase('write'):
+            with open(filename + '.tmp', 'w') as file_ptr:
+                json.dump(snapshot, file_ptr)
+            os.rename(filename + '.tmp', filename)
+
     def get_all_applications(self):
         """
         retrieve all Marathon application definitions and return
-        an dictionary with app_id -> app_definition.
+        an dictionary with app_id -> app_definition. If a `snapshot_cache_dir` is set, the
+        applications are only retrieved when the root group version differs from the snapshot.
         """
+        version = None
+        if self.snapshot_cache_dir is not None:
+            version = self.get_root_group_version()
+            snapshot = self.read_snapshot()
+            if version is not None and snapshot.get('version') == version \
+                    and snapshot.get('marathon_url') == self.marathon_url:
+                self.deployed_versions.update(snapshot['versions'])
+                return snapshot['apps']
+
         apps = {}
-        result = requests.get(self.marathon_url +
-                              "/v2/apps", headers=self.headers, verify=self.verify_ssl)
-        if result.status_code == 200:
-            for app in result.json()['apps']:
+        with self.metrics.phase('fetch'):
+            result = self.request('GET', '/v2/apps')
+            body = result.json() if result.status_code == 200 else None
+        if body is not None:
+            for app in body['apps']:
                 app_id = app['id']
                 apps[app_id] = app
+                self.deployed_versions[app_id] = app.get('version')
         elif result.status_code == 404:
             pass
         else:
-            sys.stderr.write(
+            log(
                 'ERROR: could not retrieve applications from "%s", status %d\n' % (
                     self.marathon_url, result.status_code))
             sys.exit(1)
 
+        if version is not None:
+            self.write_snapshot(version, apps)
         return apps
 
+    def iter_all_applications(self):
+        """
+        retrieve all Marathon application definitions, and yield them one by one
+        while the response is read.
+        """
+        with self.metrics.phase('fetch'):
+            result = self.request('GET', '/v2/apps', stream=True)
+        try:
+            if result.status_code == 200:
+                chunks = codecs.iterdecode(result.iter_content(chunk_size=64 * 1024), 'utf-8')
+                for app in iter_json_array(chunks, 'apps'):
+                    yield app
+            elif result.status_code == 404:
+                pass
+            else:
+                log(
+                    'ERROR: could not retrieve applications from "%s", status %d\n' % (
+                        self.marathon_url, result.status_code))
+                sys.exit(1)
+        finally:
+            self.metrics.record_received('GET', '/v2/apps', getattr(result.raw, 'tell', lambda: 0)())
+            result.close()
+
     def save_application_definitions(self, apps, directory):
+        """
+        writes the cleaned application definitions `apps` to the `directory`. `apps` is either
+        a dictionary app_id -> app_definition or an iterable of application definitions, which
+        are written as they arrive, by `write_workers` threads. Unchanged files are not touched.
+        returns the number of saved applications.
+        """
         directory = os.path.abspath(directory)
         if not os.path.exists(directory):
             os.makedirs(directory)
 
-        for app_id in apps:
-            app = apps[app_id]
+        if isinstance(apps, dict):
+            apps = apps.values()
+
+        count, changed = 0, 0
+        if self.write_workers == 1:
+            for app in apps:
+                changed += self.write_application_definition(app, directory)
+                count += 1
+        else:
+            from collections import deque
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(self.write_workers)
+            pending = deque()
+            try:
+                # the applications are read on this thread, while at most two writes per worker are queued
+                for app in apps:
+                    pending.append(pool.apply_async(self.write_application_definition, (app, directory)))
+                    count += 1
+                    if len(pending) > 2 * self.write_workers:
+                        changed += pending.popleft().get()
+                while len(pending) > 0:
+                    changed += pending.popleft().get()
+            finally:
+                pool.terminate()
+
+        log('INFO: %d application definitions changed, %d unchanged.\n' % (changed, count - changed))
+        return count
+
+    def write_application_definition(self, app, directory):
+        """
+        writes the cleaned application definition `app` to the `directory`, unless the file already has
+        the same content. The file is replaced atomically. returns True if the file was written.
+        """
+        with self.metrics.phase('write', app['id']):
             self.clean_app(app)
-            filename = os.path.join(directory, './%s.json' % app_id)
-            with open(filename, 'w') as file_ptr:
-                json.dump(app, file_ptr, indent=2)
+            content = json.dumps(app, indent=2)
+            if not isinstance(content, bytes):
+                content = content.encode('utf-8')
+            filename = os.path.join(directory, './%s.json' % app['id'])
+            if os.path.isfile(filename):
+                with open(filename, 'rb') as file_ptr:
+                    if file_ptr.read() == content:
+                        return False
+
+            with open(filename + '.tmp', 'wb') as file_ptr:
+                file_ptr.write(content)
+            os.rename(filename + '.tmp', filename)
+            return True
+
+
+_render_deployer = None
+
+
+def _init_render_worker(domain_name, domain_layers, template_cache_dir):
+    global _render_deployer
+    _render_deployer = MarathonDeployer(domain_name, template_cache_dir=template_cache_dir)
+    _render_deployer.domain_layers = domain_layers
+
+
+def _render_worker(path):
+    """
+    renders the template `path` in a render worker process, returning the application
+    definition and the error message.
+    """
+    try:
+        return _render_deployer.render_application_definition(path), None
+    except RenderError as error:
+        return None, str(error)
 
 
 @click.group()
@@ -308,9 +2101,13 @@ def cli():
 
 
 @cli.command()
-@click.option('--domain-name',
-              required=True,
-              help='to deploy to.')
+@click.option('--domain-name', 'domain_names',
+              multiple=True,
+              help='to deploy to, may be repeated.')
+@click.option('--all-domains',
+              default=False,
+              is_flag=True,
+              help='deploy to all domains defined in cfg/domain.cfg.')
 @click.option('--dry-run',
               default=False,
               is_flag=True,
@@ -326,9 +2123,53 @@ def cli():
 @click.option('--verify-ssl/--no-verify-ssl',
               required=False, default=True,
               help='ignore ssl verification errors.')
+@click.option('--parallelism',
+              type=click.IntRange(1, None), default=1,
+              help='number of concurrent requests to Marathon.')
+@click.option('--template-cache',
+              default=False,
+              is_flag=True,
+              help='cache compiled templates in %s.' % TEMPLATE_CACHE_DIR)
+@click.option('--render-cache',
+              default=False,
+              is_flag=True,
+              help='only render templates of which the inputs changed since the last run.')
+@click.option('--render-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of processes rendering the templates.')
+@click.option('--snapshot-cache',
+              default=False,
+              is_flag=True,
+              help='reuse the deployed applications retrieved by a previous run, if unchanged.')
+@click.option('--batch-size',
+              type=click.IntRange(0, None), default=0,
+              help='number of applications to create or update per Marathon deployment.')
+@click.option('--wait',
+              default=False,
+              is_flag=True,
+              help='wait until the deployments have finished.')
+@click.option('--wait-timeout',
+              type=click.IntRange(1, None), default=600,
+              help='maximum number of seconds to wait for the deployments.')
+@click.option('--max-retries',
+              type=click.IntRange(0, None), default=5,
+              help='number of times a change is retried while Marathon is busy.')
+@click.option('--select', 'selectors',
+              multiple=True,
+              help='deploy the applications matching an id glob like /payments-* or a label expression like '
+                   'TEAM=payments, comma separated terms must all match, may be repeated.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
 @click.argument('applications',
                 nargs=-1)
-def deploy(domain_name, dry_run, verbose, all_applications, verify_ssl, applications):
+def deploy(domain_names, all_domains, dry_run, verbose, all_applications, verify_ssl, parallelism, template_cache,
+           render_cache, render_workers, snapshot_cache, batch_size, wait, wait_timeout, max_retries,
+           selectors, profile, metrics_file, applications):
     """
         deploys selected or all application definitions to the domain 'domain-name'.
 
@@ -339,50 +2180,290 @@ def deploy(domain_name, dry_run, verbose, all_applications, verify_ssl, applicat
 
     applications = map(lambda id: '/%s' %
                        id if id[0] != '/' else id, applications)
-    deployer = MarathonDeployer(
-        domain_name, verify_ssl=verify_ssl, dry_run=dry_run, verbose=verbose)
-    apps = deployer.load_all_app_definitions()
+    metrics = {}
 
-    sys.stderr.write(
-        'INFO: loaded %d applications defined in ./apps\n' % len(apps))
-    if all_applications:
-        applications = apps
+    def deploy_domain(domain_name):
+        deployer = MarathonDeployer(
+            domain_name, verify_ssl=verify_ssl, dry_run=dry_run, verbose=verbose, parallelism=parallelism,
+            template_cache_dir=TEMPLATE_CACHE_DIR if template_cache else None,
+            render_cache_dir=RENDER_CACHE_DIR if render_cache else None, render_workers=render_workers,
+            snapshot_cache_dir=SNAPSHOT_CACHE_DIR if snapshot_cache else None,
+            batch_size=batch_size, wait_timeout=wait_timeout if wait else None, max_retries=max_retries,
+            index_dir=INDEX_DIR)
+        metrics[domain_name] = deployer.metrics
+        if all_applications:
+            apps = deployer.load_all_app_definitions()
+        elif selectors:
+            apps = deployer.select_app_definitions(selectors)
+            apps.update(deployer.load_app_definitions(applications))
+        else:
+            apps = deployer.load_app_definitions(applications)
 
-    if applications is None or len(applications) == 0:
-        sys.stderr.write(
-            'ERROR: no applications to deploy, specify specific ones or use --all-applications\n')
-        sys.exit(1)
+        log(
+            'INFO: loaded %d applications defined in ./apps\n' % len(apps))
+        selected_applications = sorted(apps) if all_applications or selectors else applications
 
-    for app_id in applications:
-        if app_id in apps:
-            deployer.deploy_application(apps[app_id])
-        else:
-            sys.stderr.write('WARN: No application "%s" found\n' % app_id)
+        if selected_applications is None or len(selected_applications) == 0:
+            log(
+                'ERROR: no applications to deploy, specify specific ones or use --all-applications\n')
+            sys.exit(1)
+
+        selected = []
+        for app_id in selected_applications:
+            if app_id in apps:
+                selected.append(apps[app_id])
+            else:
+                log('WARN: No application "%s" found\n' % app_id)
+
+        deployer.deploy_applications(selected)
+
+    try:
+        run_for_domains(select_domains(domain_names, all_domains), deploy_domain)
+    finally:
+        report_metrics(metrics, profile, metrics_file)
 
 
 @cli.command()
-@click.option('--domain-name',
-              required=True,
-              help='to deploy to.')
+@click.option('--domain-name', 'domain_names',
+              multiple=True,
+              help='to compare with, may be repeated.')
+@click.option('--all-domains',
+              default=False,
+              is_flag=True,
+              help='compare with all domains defined in cfg/domain.cfg.')
 @click.option('--verify-ssl/--no-verify-ssl',
               required=False, default=True,
               help='ignore ssl verification errors.')
-def diff(domain_name, verify_ssl):
+@click.option('--parallelism',
+              type=click.IntRange(1, None), default=1,
+              help='number of concurrent requests to Marathon.')
+@click.option('--template-cache',
+              default=False,
+              is_flag=True,
+              help='cache compiled templates in %s.' % TEMPLATE_CACHE_DIR)
+@click.option('--render-cache',
+              default=False,
+              is_flag=True,
+              help='only render templates of which the inputs changed since the last run.')
+@click.option('--render-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of processes rendering the templates.')
+@click.option('--snapshot-cache',
+              default=False,
+              is_flag=True,
+              help='reuse the deployed applications retrieved by a previous run, if unchanged.')
+@click.option('--select', 'selectors',
+              multiple=True,
+              help='compare the applications matching an id glob like /payments-* or a label expression like '
+                   'TEAM=payments, comma separated terms must all match, may be repeated.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+def diff(domain_names, all_domains, verify_ssl, parallelism, template_cache, render_cache, render_workers,
+         snapshot_cache, selectors, profile, metrics_file):
     """
         differences between defined and deployed application definitions.
     """
+    metrics = {}
+
+    def diff_domain(domain_name):
+        deployer = MarathonDeployer(
+            domain_name, verify_ssl=verify_ssl, dry_run=True, verbose=True, parallelism=parallelism,
+            template_cache_dir=TEMPLATE_CACHE_DIR if template_cache else None,
+            render_cache_dir=RENDER_CACHE_DIR if render_cache else None, render_workers=render_workers,
+            snapshot_cache_dir=SNAPSHOT_CACHE_DIR if snapshot_cache else None, index_dir=INDEX_DIR)
+        metrics[domain_name] = deployer.metrics
+        if selectors:
+            applications = deployer.select_app_definitions(selectors)
+        else:
+            applications = deployer.load_all_app_definitions()
+        log(
+            'INFO: loaded %d applications from ./apps\n' % len(applications))
+
+        if len(applications) == 0:
+            log('ERROR: no applications found to deploy.\n')
+            sys.exit(1)
+
+        deployer.deploy_applications(list(applications.values()))
+
+    try:
+        run_for_domains(select_domains(domain_names, all_domains), diff_domain)
+    finally:
+        report_metrics(metrics, profile, metrics_file)
+
+
+@cli.command()
+@click.option('--domain-name', required=True, help='to plan the release for.')
+@click.option('--plan-file',
+              type=click.Path(dir_okay=False), default='plan.json',
+              help='the file to write the plan to.')
+@click.option('--verbose',
+              default=False,
+              is_flag=True,
+              help='show changes that are planned.')
+@click.option('--all-applications',
+              default=False,
+              is_flag=True,
+              help='plan all applications.')
+@click.option('--verify-ssl/--no-verify-ssl',
+              required=False, default=True,
+              help='ignore ssl verification errors.')
+@click.option('--parallelism',
+              type=click.IntRange(1, None), default=1,
+              help='number of concurrent requests to Marathon.')
+@click.option('--template-cache',
+              default=False,
+              is_flag=True,
+              help='cache compiled templates in %s.' % TEMPLATE_CACHE_DIR)
+@click.option('--render-cache',
+              default=False,
+              is_flag=True,
+              help='only render templates of which the inputs changed since the last run.')
+@click.option('--render-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of processes rendering the templates.')
+@click.option('--snapshot-cache',
+              default=False,
+              is_flag=True,
+              help='reuse the deployed applications retrieved by a previous run, if unchanged.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+@click.argument('applications',
+                nargs=-1)
+def plan(domain_name, plan_file, verbose, all_applications, verify_ssl, parallelism, template_cache, render_cache,
+         render_workers, snapshot_cache, profile, metrics_file, applications):
+    """
+        writes the operations to deploy selected or all application definitions to the domain to a plan file.
+
+        the plan contains the rendered application definitions and the deployed version of each
+        application, and is deployed by the apply command.
+    """
+    applications = ['/%s' % app_id if app_id[0] != '/' else app_id for app_id in applications]
     deployer = MarathonDeployer(
-        domain_name, verify_ssl=verify_ssl, dry_run=True, verbose=True)
-    applications = deployer.load_all_app_definitions()
-    sys.stderr.write(
-        'INFO: loaded %d applications from ./apps\n' % len(applications))
+        domain_name, verify_ssl=verify_ssl, verbose=verbose, parallelism=parallelism,
+        template_cache_dir=TEMPLATE_CACHE_DIR if template_cache else None,
+        render_cache_dir=RENDER_CACHE_DIR if render_cache else None, render_workers=render_workers,
+        snapshot_cache_dir=SNAPSHOT_CACHE_DIR if snapshot_cache else None)
+    try:
+        if all_applications:
+            apps = deployer.load_all_app_definitions()
+        elif len(applications) > 0:
+            apps = deployer.load_app_definitions(applications)
+        else:
+            log('ERROR: no applications to plan, specify specific ones or use --all-applications\n')
+            sys.exit(1)
 
-    if len(applications) == 0:
-        sys.stderr.write('ERROR: no applications found to deploy.\n')
+        for app_id in applications:
+            if app_id not in apps:
+                log('WARN: No application "%s" found\n' % app_id)
+
+        release_plan = deployer.plan_applications(list(apps.values()))
+        with deployer.metrics.phase('write'):
+            with open(plan_file, 'w') as file_ptr:
+                json.dump(release_plan, file_ptr, separators=(',', ':'), sort_keys=True)
+        log('INFO: planned %d operations in %s\n' % (len(release_plan['operations']), plan_file))
+    finally:
+        report_metrics({domain_name: deployer.metrics}, profile, metrics_file)
+
+
+@cli.command()
+@click.option('--plan-file',
+              type=click.Path(exists=True, dir_okay=False), default='plan.json',
+              help='the plan written by the plan command.')
+@click.option('--dry-run',
+              default=False,
+              is_flag=True,
+              help='only check the plan, do not do actual deploy.')
+@click.option('--verify-ssl/--no-verify-ssl',
+              required=False, default=True,
+              help='ignore ssl verification errors.')
+@click.option('--parallelism',
+              type=click.IntRange(1, None), default=1,
+              help='number of concurrent requests to Marathon.')
+@click.option('--batch-size',
+              type=click.IntRange(0, None), default=0,
+              help='number of applications to create or update per Marathon deployment.')
+@click.option('--wait',
+              default=False,
+              is_flag=True,
+              help='wait until the deployments have finished.')
+@click.option('--wait-timeout',
+              type=click.IntRange(1, None), default=600,
+              help='maximum number of seconds to wait for the deployments.')
+@click.option('--max-retries',
+              type=click.IntRange(0, None), default=5,
+              help='number of times a change is retried while Marathon is busy.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+def apply(plan_file, dry_run, verify_ssl, parallelism, batch_size, wait, wait_timeout, max_retries,
+          profile, metrics_file):
+    """
+        deploys the plan written by the plan command, if none of the planned applications has changed since.
+    """
+    try:
+        with open(plan_file, 'r') as file_ptr:
+            release_plan = json.load(file_ptr)
+    except ValueError as e:
+        log('ERROR: invalid plan %s, %s\n' % (plan_file, e))
         sys.exit(1)
 
-    for app_id in applications.keys():
-        deployer.deploy_application(applications[app_id])
+    deployer = MarathonDeployer(
+        release_plan['domain_name'], verify_ssl=verify_ssl, dry_run=dry_run, parallelism=parallelism,
+        batch_size=batch_size, wait_timeout=wait_timeout if wait else None,
+        max_retries=max_retries)
+    try:
+        deployer.apply_plan(release_plan)
+    finally:
+        report_metrics({deployer.domain_name: deployer.metrics}, profile, metrics_file)
+
+
+@cli.command()
+@click.option('--domain-name', required=True, help='to watch.')
+@click.option('--apply',
+              default=False,
+              is_flag=True,
+              help='deploy the applications which differ from their definition.')
+@click.option('--verbose',
+              default=False,
+              is_flag=True,
+              help='show the differences.')
+@click.option('--verify-ssl/--no-verify-ssl',
+              required=False, default=True,
+              help='ignore ssl verification errors.')
+@click.option('--interval',
+              type=float, default=1.0,
+              help='seconds between checks for changed files when polling.')
+@click.option('--refresh-interval',
+              type=float, default=30,
+              help='seconds between checks for changes in Marathon.')
+@click.option('--polling',
+              default=False,
+              is_flag=True,
+              help='poll for changed files, instead of using inotify.')
+def watch(domain_name, apply, verbose, verify_ssl, interval, refresh_interval, polling):
+    """
+        reports the applications in ./apps which differ from the deployed applications, whenever an application
+        definition, its configuration or the domain configuration changes, or the deployed applications change.
+    """
+    deployer = MarathonDeployer(domain_name, dry_run=not apply, verbose=verbose, verify_ssl=verify_ssl)
+    try:
+        deployer.watch_applications(interval=interval, refresh_interval=refresh_interval, polling=polling)
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command()
@@ -393,7 +2474,17 @@ def diff(domain_name, verify_ssl):
 @click.option('--verify-ssl/--no-verify-ssl',
               required=False, default=True,
               help='ignore ssl verification errors.')
-def download(domain_name, directory, verify_ssl):
+@click.option('--write-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of threads writing the application definitions.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+def download(domain_name, directory, verify_ssl, write_workers, profile, metrics_file):
     """
         saves all application definitions deployed by marathon at the defined URL to the specified
         directory.
@@ -401,15 +2492,18 @@ def download(domain_name, directory, verify_ssl):
     if directory is None:
         directory = os.path.abspath(os.path.join('current', domain_name))
 
-    deployer = MarathonDeployer(domain_name, verify_ssl=verify_ssl)
-    apps = deployer.get_all_applications()
-    if len(apps) > 0:
-        sys.stderr.write('INFO: saving %d applications to %s.\n' %
-                         (len(apps), directory))
-        deployer.save_application_definitions(apps, directory)
-    else:
-        sys.stderr.write('WARN: no applications deployed at %s.\n' %
-                         deployer.marathon_url)
+    deployer = MarathonDeployer(domain_name, verify_ssl=verify_ssl, write_workers=write_workers)
+    try:
+        log('INFO: saving applications to %s.\n' % directory)
+        count = deployer.save_application_definitions(deployer.iter_all_applications(), directory)
+        if count > 0:
+            log('INFO: saved %d applications to %s.\n' %
+                (count, directory))
+        else:
+            log('WARN: no applications deployed at %s.\n' %
+                deployer.marathon_url)
+    finally:
+        report_metrics({domain_name: deployer.metrics}, profile, metrics_file)
 
 
 @cli.command()
@@ -421,17 +2515,42 @@ def download(domain_name, directory, verify_ssl):
 @click.option('--verify-ssl/--no-verify-ssl',
               required=False, default=True,
               help='ignore ssl verification errors.')
-def delete(domain_name, dry_run, verify_ssl):
+@click.option('--parallelism',
+              type=click.IntRange(1, None), default=8,
+              help='number of concurrent requests to Marathon.')
+@click.option('--snapshot-cache',
+              default=False,
+              is_flag=True,
+              help='reuse the deployed applications retrieved by a previous run, if unchanged.')
+@click.option('--max-retries',
+              type=click.IntRange(0, None), default=5,
+              help='number of times a change is retried while Marathon is busy.')
+@click.option('--select', 'selectors',
+              multiple=True,
+              help='delete the applications matching an id glob like /payments-* or a label expression like '
+                   'TEAM=payments, comma separated terms must all match, may be repeated.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+def delete(domain_name, dry_run, verify_ssl, parallelism, snapshot_cache, max_retries, selectors, profile,
+           metrics_file):
     """
         deletes all undefined applications deployed without an application definition in ./apps.
     """
     deployer = MarathonDeployer(
-        domain_name, verify_ssl=verify_ssl, dry_run=dry_run)
-    defined_apps = deployer.load_all_app_definitions().keys()
-    deployed_apps = deployer.get_all_applications().keys()
-    undefined_apps = set(deployed_apps).difference(set(defined_apps))
-    for app_id in undefined_apps:
-        deployer.delete_application(app_id)
+        domain_name, verify_ssl=verify_ssl, dry_run=dry_run, parallelism=parallelism,
+        snapshot_cache_dir=SNAPSHOT_CACHE_DIR if snapshot_cache else None, max_retries=max_retries)
+    try:
+        # the ids of the templates suffice, as the id of an application must match the name of its template
+        # and the selectors are matched against the deployed labels.
+        defined_apps = deployer.template_paths().keys()
+        deployer.prune_applications(defined_apps, [parse_selector(selector) for selector in selectors])
+    finally:
+        report_metrics({domain_name: deployer.metrics}, profile, metrics_file)
 
 
 @cli.command()
@@ -442,31 +2561,82 @@ def delete(domain_name, dry_run, verify_ssl):
 @click.option('--output-directory',
               type=click.Path(file_okay=False),
               help='the directory with the generated application definitions.')
-@click.option('--domain-name',
-              required=True,
-              help='to generate the application definitions for.')
+@click.option('--domain-name', 'domain_names',
+              multiple=True,
+              help='to generate the application definitions for, may be repeated.')
+@click.option('--all-domains',
+              default=False,
+              is_flag=True,
+              help='generate the application definitions for all domains defined in cfg/domain.cfg.')
 @click.option('--verify-ssl/--no-verify-ssl',
               required=False, default=True,
               help='ignore ssl verification errors.')
-def generate(input_directory, output_directory, domain_name, verify_ssl):
+@click.option('--template-cache',
+              default=False,
+              is_flag=True,
+              help='cache compiled templates in %s.' % TEMPLATE_CACHE_DIR)
+@click.option('--render-cache',
+              default=False,
+              is_flag=True,
+              help='only render templates of which the inputs changed since the last run.')
+@click.option('--render-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of processes rendering the templates.')
+@click.option('--write-workers',
+              type=click.IntRange(1, None), default=1,
+              help='number of threads writing the application definitions.')
+@click.option('--select', 'selectors',
+              multiple=True,
+              help='generate the applications matching an id glob like /payments-* or a label expression like '
+                   'TEAM=payments, comma separated terms must all match, may be repeated.')
+@click.option('--profile',
+              default=False,
+              is_flag=True,
+              help='print the time per phase and the requests per Marathon endpoint.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False),
+              help='write the time per phase and the requests per Marathon endpoint as JSON to this file.')
+def generate(input_directory, output_directory, domain_names, all_domains, verify_ssl, template_cache, render_cache,
+             render_workers, write_workers, selectors, profile, metrics_file):
     """
     generates application definitions for a domain.
     """
-    deployer = MarathonDeployer(domain_name, verify_ssl=verify_ssl)
-    if output_directory is None:
-        output_directory = os.path.join('.', 'deployments', domain_name)
-
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
-
-    apps = deployer.load_all_app_definitions(input_directory)
-    if len(apps) > 0:
-        sys.stderr.write('INFO: generating %d applications to %s.\n' %
-                         (len(apps), output_directory))
-        deployer.save_application_definitions(apps, output_directory)
-    else:
-        sys.stderr.write(
-            'INFO: no applications defined at %s.\n' % input_directory)
+    domain_names = select_domains(domain_names, all_domains)
+    metrics = {}
+
+    def generate_domain(domain_name):
+        deployer = MarathonDeployer(domain_name, verify_ssl=verify_ssl,
+                                    template_cache_dir=TEMPLATE_CACHE_DIR if template_cache else None,
+                                    render_cache_dir=RENDER_CACHE_DIR if render_cache else None,
+                                    render_workers=render_workers, write_workers=write_workers,
+                                    index_dir=INDEX_DIR)
+        metrics[domain_name] = deployer.metrics
+        if output_directory is None:
+            directory = os.path.join('.', 'deployments', domain_name)
+        elif len(domain_names) > 1:
+            directory = os.path.join(output_directory, domain_name)
+        else:
+            directory = output_directory
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        if selectors:
+            apps = deployer.select_app_definitions(selectors, input_directory)
+        else:
+            apps = deployer.load_all_app_definitions(input_directory)
+        if len(apps) > 0:
+            log('INFO: generating %d applications to %s.\n' %
+                (len(apps), directory))
+            deployer.save_application_definitions(apps, directory)
+        else:
+            log(
+                'INFO: no applications defined at %s.\n' % input_directory)
+
+    try:
+        run_for_domains(domain_names, generate_domain)
+    finally:
+        report_metrics(metrics, profile, metrics_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,261 @@
+"""
+ a minimal in-process Marathon, serving just enough of the REST API to test marathon-release against.
+"""
+import json
+import time
+import posixpath
+import threading
+
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubMarathon(object):
+    """
+    keeps a dictionary of application definitions and records every request as a (method, path) tuple.
+
+    Every change starts a deployment, which finishes after `deployment_delay` seconds, or never
+    if the delay is None. Finished deployments are published on the /v2/events stream, unless
+    `events` is False. The ids of deployments which should fail are listed in `failing_deployments`.
+    Each response is delayed by `latency` seconds. /v2/leader reports `leader` as the leading master,
+    and all other requests are redirected to `redirect_to`, if set. Writes are answered with the
+    (status code, body, headers) tuples in `failures`, until none are left. The group tree is derived
+    from the ids of the applications and of the `pods`.
+    """
+
+    def __init__(self, apps=None, deployment_delay=0, events=True, latency=0):
+        self.apps = {}
+        self.requests = []
+        self.version = 1
+        self.deployments = {}
+        self.deployment_delay = deployment_delay
+        self.failing_deployments = set()
+        self.events = events
+        self.latency = latency
+        self.leader = None
+        self.redirect_to = None
+        self.failures = []
+        self.pods = []
+        self.subscribers = []
+        self.stopped = threading.Event()
+        self.lock = threading.Lock()
+        for app in apps or []:
+            self.apps[app['id']] = app
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,))
+        self.thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://%s' % self.netloc
+
+    @property
+    def netloc(self):
+        return '127.0.0.1:%d' % self.server.server_address[1]
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, method, path=None):
+        return len([r for r in self.requests if r[0] == method and (path is None or r[1] == path)])
+
+    def start_deployment(self, app_ids):
+        """
+        starts a deployment of `app_ids` and returns its id.
+        """
+        self.version += 1
+        deployment_id = 'd-%d' % self.version
+        self.deployments[deployment_id] = app_ids
+        if self.deployment_delay is not None:
+            timer = threading.Timer(self.deployment_delay, self.finish_deployment, args=(deployment_id,))
+            timer.daemon = True
+            timer.start()
+        return deployment_id
+
+    def finish_deployment(self, deployment_id):
+        with self.lock:
+            self.deployments.pop(deployment_id, None)
+            event_type = 'deployment_failed' if deployment_id in self.failing_deployments else 'deployment_success'
+            for subscriber in self.subscribers:
+                subscriber.put({'eventType': event_type, 'id': deployment_id})
+
+    def handle(self, method, path, body):
+        """
+        returns the status code and response body for the request.
+        """
+        with self.lock:
+            self.requests.append((method, path))
+            url = urlparse(path)
+            path, query = url.path, parse_qs(url.query)
+            if path == '/v2/leader' and method == 'GET':
+                return (200, {'leader': self.leader}) if self.leader else (404, {'message': 'There is no leader'})
+
+            if path == '/v2/apps':
+                if method == 'GET':
+                    return 200, {'apps': list(self.apps.values())}
+                if method == 'POST':
+                    self.apps[body['id']] = body
+                    deployment_id = self.start_deployment([body['id']])
+                    return 201, dict(body, deployments=[{'id': deployment_id}])
+                if method == 'PUT':
+                    for app in body:
+                        self.apps[app['id']] = app
+                    deployment_id = self.start_deployment([app['id'] for app in body])
+                    return 200, {'version': '2017-01-01T00:00:00.000Z', 'deploymentId': deployment_id}
+
+            elif path.startswith('/v2/apps/'):
+                app_id = '/' + path[len('/v2/apps/'):].lstrip('/')
+                if method == 'PUT':
+                    self.apps[app_id] = body
+                    deployment_id = self.start_deployment([app_id])
+                    return 200, {'version': '2017-01-01T00:00:00.000Z', 'deploymentId': deployment_id}
+                if app_id not in self.apps:
+                    return 404, {'message': 'App \'%s\' does not exist' % app_id}
+                if method == 'GET':
+                    return 200, {'app': self.apps[app_id]}
+                if method == 'DELETE':
+                    del self.apps[app_id]
+                    deployment_id = self.start_deployment([app_id])
+                    return 200, {'version': '2017-01-01T00:00:00.000Z', 'deploymentId': deployment_id}
+
+            elif path == '/v2/groups' and method == 'GET':
+                return 200, self.group_tree(query.get('embed'))
+
+            elif path.startswith('/v2/groups/') and method == 'DELETE':
+                group_id = '/' + path[len('/v2/groups/'):].strip('/')
+                app_ids = [app_id for app_id in self.apps if app_id.startswith(group_id + '/')]
+                if len(app_ids) == 0:
+                    return 404, {'message': 'Group \'%s\' does not exist' % group_id}
+                for app_id in app_ids:
+                    del self.apps[app_id]
+                deployment_id = self.start_deployment(app_ids)
+                return 200, {'version': '2017-01-01T00:00:00.000Z', 'deploymentId': deployment_id}
+
+            elif path == '/v2/deployments' and method == 'GET':
+                return 200, [{'id': deployment_id, 'affectedApps': app_ids}
+                             for deployment_id, app_ids in self.deployments.items()]
+
+            return 404, {'message': 'not found'}
+
+    def group_tree(self, embed=None):
+        """
+        returns the root group, with the nested groups holding the applications and pods. Like Marathon,
+        the applications are only included if `embed` asks for them, or if no embed is given.
+        """
+        root = {'id': '/', 'version': '2017-01-01T00:00:%02d.000Z' % self.version, 'groups': [], 'pods': []}
+        groups = {'/': root}
+
+        def group(group_id):
+            if group_id not in groups:
+                groups[group_id] = {'id': group_id, 'groups': [], 'pods': []}
+                group(posixpath.dirname(group_id))['groups'].append(groups[group_id])
+            return groups[group_id]
+
+        for app_id in sorted(self.apps):
+            parent = group(posixpath.dirname(app_id))
+            if not embed or 'group.apps' in embed:
+                parent.setdefault('apps', []).append(dict(self.apps[app_id]))
+        for pod_id in sorted(self.pods):
+            group(posixpath.dirname(pod_id))['pods'].append({'id': pod_id})
+        return root
+
+    def stream_events(self, request):
+        """
+        streams the deployment events to `request` as server sent events, until the stub is stopped.
+        """
+        subscriber = Queue()
+        with self.lock:
+            self.requests.append((request.command, request.path))
+            self.subscribers.append(subscriber)
+
+        request.send_response(200)
+        request.send_header('Content-Type', 'text/event-stream')
+        request.end_headers()
+        request.wfile.write(b'event: event_stream_attached\ndata: {}\n\n')
+        request.wfile.flush()
+        try:
+            while not self.stopped.is_set():
+                try:
+                    event = subscriber.get(timeout=0.05)
+                except Empty:
+                    continue
+                message = 'event: %s\ndata: %s\n\n' % (event['eventType'], json.dumps(event))
+                request.wfile.write(message.encode('utf-8'))
+                request.wfile.flush()
+        except IOError:
+            pass
+        finally:
+            with self.lock:
+                self.subscribers.remove(subscriber)
+
+    def handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, format, *args):
+                pass
+
+            def respond(self):
+                if stub.latency > 0:
+                    time.sleep(stub.latency)
+                if self.path.startswith('/v2/events') and stub.events:
+                    stub.stream_events(self)
+                    return
+
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+                if stub.redirect_to is not None and not self.path.startswith('/v2/leader'):
+                    with stub.lock:
+                        stub.requests.append((self.command, self.path))
+                    self.send_response(307)
+                    self.send_header('Location', stub.redirect_to + self.path)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+
+                headers = {}
+                with stub.lock:
+                    failure = stub.failures.pop(0) if self.command != 'GET' and len(stub.failures) > 0 else None
+                    if failure is not None:
+                        stub.requests.append((self.command, self.path))
+                if failure is not None:
+                    status, response, headers = failure
+                else:
+                    status, response = stub.handle(self.command, self.path, body)
+                content = json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = do_PUT = do_DELETE = respond
+
+        return Handler
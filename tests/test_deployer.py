@@ -1,6 +1,13 @@
 import json
 import os
+import sys
+import time
+import subprocess
+import jsondiff
+import pytest
+from click.testing import CliRunner
 from marathon_release import cli
+from tests.marathon_stub import StubMarathon
 
 
 def test_empty_values(pytestconfig):
@@ -88,3 +95,764 @@ def test_load_app_definition(pytestconfig):
     assert apps['/b']['id'] == '/b'
     assert apps['/a']['env']['RELEASE'] == '1.1'
     assert apps['/b']['env']['RELEASE'] == '1.0'
+
+
+def test_bulk_reconciliation(pytestconfig):
+    """
+    the deployed state is retrieved once when many applications are deployed.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', bulk_fetch_threshold=1)
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+    deployed = json.loads(json.dumps(apps['/a']))
+    deployed['version'] = '2017-01-01T00:00:00.000Z'
+
+    with StubMarathon([deployed]) as marathon:
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/a'], apps['/b']])
+
+        assert marathon.count('GET') == 1
+        assert marathon.count('GET', '/v2/apps') == 1
+        assert marathon.count('POST', '/v2/apps') == 1
+        assert marathon.count('PUT') == 0
+
+
+def test_parallel_deploy(pytestconfig, capsys):
+    """
+    applications are deployed concurrently, while the output remains in order.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', parallelism=4)
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+
+    with StubMarathon() as marathon:
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/b'], apps['/a']])
+
+        assert marathon.count('POST', '/v2/apps') == 2
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines == ['INFO: deploying new application "/b"',
+                     'INFO: deployment running for application "/b"',
+                     'INFO: deploying new application "/a"',
+                     'INFO: deployment running for application "/a"']
+
+
+def test_parallel_failure_output(capsys):
+    """
+    when a call fails, the output of all the calls is still written in order before the error is raised.
+    """
+    def create(app_id):
+        cli.log('INFO: deploying new application "%s"\n' % app_id)
+        if app_id == '/x0':
+            raise ValueError('no application definition for "%s"' % app_id)
+
+    with pytest.raises(ValueError):
+        cli.run_parallel(create, ['/x0', '/x1', '/x2', '/x3'], 4)
+
+    assert capsys.readouterr().err.splitlines() == \
+        ['INFO: deploying new application "/x%d"' % i for i in range(4)]
+
+
+def test_layered_configuration(tmpdir):
+    """
+    the application configuration is overlayed on the domain configuration, which is read once.
+    """
+    tmpdir.join('cfg', 'domain.cfg').write(
+        '[DEFAULT]\nmarathon_url = http://%(host)s\nhost = localhost\nrelease = 0.1\n'
+        '[test]\nplatform = marathon\ninstances = 1\n[prd]\nplatform = marathon\ninstances = 3\n', ensure=True)
+    tmpdir.join('apps', 'c.cfg').write('[DEFAULT]\nrelease = 1.0\ninstances = 2\n', ensure=True)
+    tmpdir.join('apps', 'c.json').write(
+        '{"id": "/c", "env": {"RELEASE": "{{release}}", "INSTANCES": "{{instances}}", "URL": "{{marathon_url}}"}}')
+    tmpdir.join('apps', 'd.json').write('{"id": "/d", "env": {"RELEASE": "{{release}}"}}')
+    tmpdir.chdir()
+
+    deployer = cli.MarathonDeployer('test')
+    tmpdir.join('cfg', 'domain.cfg').remove()
+    apps = deployer.load_all_app_definitions(directory=str(tmpdir.join('apps')))
+
+    assert apps['/c']['env'] == {'RELEASE': '1.0', 'INSTANCES': '1', 'URL': 'http://localhost'}
+    assert apps['/d']['env'] == {'RELEASE': '0.1'}
+
+    assert deployer.read_domain_cfg().sections() == ['test']
+    cfg_file = str(tmpdir.join('apps', 'c.cfg'))
+    assert deployer.read_app_cfg(cfg_file) is deployer.read_app_cfg(cfg_file)
+    tmpdir.join('apps', 'c.cfg').write('[DEFAULT]\nrelease = 1.1\n[prd]\nrelease = 2.0\n')
+    assert deployer.read_app_cfg(cfg_file)['release'] == '1.1'
+
+
+def test_template_cache(pytestconfig, tmpdir):
+    """
+    compiled templates are cached on disk and invalidated when the template changes.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    appsdir = tmpdir.join('apps')
+    appsdir.join('a.json').write('{"id": "/a", "env": {"NAME": "{{domain_name}}"}}', ensure=True)
+    cachedir = str(tmpdir.join('cache'))
+
+    deployer = cli.MarathonDeployer('test', template_cache_dir=cachedir)
+    apps = deployer.load_all_app_definitions(directory=str(appsdir))
+    assert apps['/a']['env'] == {'NAME': 'test'}
+    assert len(os.listdir(cachedir)) == 1
+
+    appsdir.join('a.json').write('{"id": "/a", "env": {"DOMAIN": "{{domain_name}}"}}')
+    deployer = cli.MarathonDeployer('test', template_cache_dir=cachedir)
+    apps = deployer.load_all_app_definitions(directory=str(appsdir))
+    assert apps['/a']['env'] == {'DOMAIN': 'test'}
+
+
+def test_render_cache(pytestconfig, tmpdir):
+    """
+    templates are only rendered when one of their inputs changed.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    appsdir = os.path.join(testdir, 'apps')
+    cachedir = str(tmpdir.join('render'))
+
+    deployer = cli.MarathonDeployer('test', render_cache_dir=cachedir)
+    apps = deployer.load_all_app_definitions(directory=appsdir)
+    assert len(apps) == 2
+
+    deployer = cli.MarathonDeployer('test', render_cache_dir=cachedir)
+    deployer.get_jinja_environment = None
+    assert deployer.load_all_app_definitions(directory=appsdir) == apps
+
+    deployer = cli.MarathonDeployer('test', render_cache_dir=cachedir)
+    deployer.domain_layers['test']['extra'] = 'changed'
+    rendered = []
+    get_jinja_environment = deployer.get_jinja_environment
+    deployer.get_jinja_environment = lambda directory: rendered.append(directory) or get_jinja_environment(directory)
+    assert deployer.load_app_definitions(['/a', '/c'], directory=appsdir) == {'/a': apps['/a']}
+    assert rendered == [appsdir]
+
+
+def test_render_workers(pytestconfig, tmpdir, capsys):
+    """
+    templates are rendered by a pool of processes, and all errors are reported together.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    appsdir = os.path.join(testdir, 'apps')
+
+    deployer = cli.MarathonDeployer('test', render_workers=2)
+    assert deployer.load_all_app_definitions(directory=appsdir) == \
+        cli.MarathonDeployer('test').load_all_app_definitions(directory=appsdir)
+
+    tmpdir.join('c.json').write('{"id": "/c"')
+    tmpdir.join('d.json').write('{"id": "/e"}')
+    tmpdir.join('f.json').write('{"id": "/f"}')
+    with pytest.raises(SystemExit):
+        deployer.load_all_app_definitions(directory=str(tmpdir))
+
+    errors = sorted(capsys.readouterr().err.splitlines())
+    assert len(errors) == 2
+    assert errors[0].startswith('ERROR: application id in template ')
+    assert errors[1].startswith('ERROR: invalidate template ')
+
+
+def test_iter_json_array():
+    """
+    the elements of a JSON array are parsed as the chunks arrive.
+    """
+    document = json.dumps({'apps': [{'id': '/a', 'tasks': [{'id': 'a.1'}]}, {'id': '/b', 'cmd': 'echo ]'}]})
+    for size in [1, 7, len(document)]:
+        chunks = [document[i:i + size] for i in range(0, len(document), size)]
+        apps = list(cli.iter_json_array(chunks, 'apps'))
+        assert apps == json.loads(document)['apps']
+
+    assert list(cli.iter_json_array(['{"apps" : [ ] }'], 'apps')) == []
+    with pytest.raises(ValueError):
+        list(cli.iter_json_array(['{"apps": [{"id": "/a"}, {"id'], 'apps'))
+
+
+def test_streaming_download(pytestconfig, tmpdir):
+    """
+    deployed applications are cleaned and saved while they are downloaded.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test')
+    with open('actual.json') as f:
+        app = json.load(f)['app']
+
+    with StubMarathon([app]) as marathon:
+        deployer.marathon_url = marathon.url
+        count = deployer.save_application_definitions(deployer.iter_all_applications(), str(tmpdir))
+
+    assert count == 1
+    with open(str(tmpdir.join('%s.json' % app['id']))) as f:
+        saved = json.load(f)
+    deployer.clean_app(app)
+    assert saved == app
+
+
+def test_fingerprint_diff(pytestconfig, monkeypatch):
+    """
+    applications are compared on the fingerprint of their normalized definitions, and only
+    a changed application is diffed in detail.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', verbose=True)
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+
+    deployed_a = json.loads(json.dumps(apps['/a']))
+    deployed_a.update({'cpus': 0.25, 'mem': 128.0, 'disk': 0, 'labels': {}, 'version': '2017'})
+    deployed_b = json.loads(json.dumps(apps['/b']))
+    deployed_b['instances'] = 2
+    assert deployer.fingerprint_app(deployer.normalize_app(deployed_a)) == \
+        deployer.fingerprint_app(deployer.normalize_app(apps['/a']))
+
+    diffed = []
+    jdiff = jsondiff.diff
+    monkeypatch.setattr(jsondiff, 'diff',
+                        lambda *args, **kwargs: diffed.append(args[1]['id']) or jdiff(*args, **kwargs))
+    with StubMarathon([deployed_a, deployed_b]) as marathon:
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/a'], apps['/b']])
+        assert marathon.count('PUT') == 1
+        assert marathon.count('PUT', '/v2/apps//b') == 1
+
+    assert diffed == ['/b']
+
+
+def test_normalize_version_specific_defaults(pytestconfig):
+    """
+    a field missing from the template is only assumed to have its Marathon default when the default
+    is the same in every version, so a deployed value for any other field is still a change.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test')
+    template = {'id': '/a', 'cmd': 'sleep 3600'}
+
+    deployed = dict(template, cpus=1.0, mem=128, disk=0, instances=1)
+    assert deployer.fingerprint_app(deployer.normalize_app(deployed)) == \
+        deployer.fingerprint_app(deployer.normalize_app(template))
+
+    for field, value in [('unreachableStrategy', {'inactiveAfterSeconds': 300, 'expungeAfterSeconds': 600}),
+                         ('maxLaunchDelaySeconds', 3600), ('backoffSeconds', 1)]:
+        deployed_with_field = dict(deployed, **{field: value})
+        assert deployer.fingerprint_app(deployer.normalize_app(deployed_with_field)) != \
+            deployer.fingerprint_app(deployer.normalize_app(template))
+
+
+def test_snapshot_cache(pytestconfig, tmpdir):
+    """
+    the deployed applications are only retrieved when the root group version has changed.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', snapshot_cache_dir=str(tmpdir))
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+
+    with StubMarathon([apps['/a']]) as marathon:
+        deployer.marathon_url = marathon.url
+        assert list(deployer.get_all_applications().keys()) == ['/a']
+        assert list(deployer.get_all_applications().keys()) == ['/a']
+        assert marathon.count('GET', '/v2/apps') == 1
+
+        deployer.deploy_applications([apps['/b']])
+        assert marathon.count('GET', '/v2/apps') == 1
+        assert marathon.count('POST', '/v2/apps') == 1
+
+        assert sorted(deployer.get_all_applications().keys()) == ['/a', '/b']
+        assert marathon.count('GET', '/v2/apps') == 2
+
+
+def test_batch_apply(pytestconfig, capsys):
+    """
+    created and updated applications are sent in chunks to PUT /v2/apps.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', batch_size=2, parallelism=2)
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+    c = dict(apps['/a'], id='/c')
+    changed = dict(apps['/b'], instances=3)
+
+    with StubMarathon([apps['/a'], changed]) as marathon:
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([c, apps['/a'], apps['/b']])
+
+        assert marathon.count('PUT', '/v2/apps') == 1
+        assert marathon.count('POST') == 0
+        assert marathon.apps['/b'] == apps['/b']
+        assert marathon.apps['/c'] == c
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[-2:] == ['INFO: deployment d-2 running for application "/c"',
+                          'INFO: deployment d-2 running for application "/b"']
+
+
+def test_dependency_waves():
+    """
+    applications are deployed in waves ordered by their dependencies.
+    """
+    apps = [{'id': '/web', 'dependencies': ['/api', 'cache']},
+            {'id': '/api', 'dependencies': ['../db', '/external']},
+            {'id': '/db'},
+            {'id': '/cache', 'dependencies': []}]
+    waves = cli.dependency_waves(apps)
+    assert [[app['id'] for app in wave] for wave in waves] == [['/db', '/cache'], ['/api'], ['/web']]
+
+    apps[2]['dependencies'] = ['/web']
+    with pytest.raises(ValueError):
+        cli.dependency_waves(apps)
+
+
+def test_wait_for_deployments(pytestconfig, capsys):
+    """
+    the deployments of a run are followed on the event stream, or polled if the stream is not available.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    apps = cli.MarathonDeployer('test').load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+    apps['/b']['dependencies'] = ['/a']
+
+    with StubMarathon(deployment_delay=0.2) as marathon:
+        deployer = cli.MarathonDeployer('test', wait_timeout=5)
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/b'], apps['/a']])
+        assert marathon.count('GET', '/v2/events?event_type=deployment_success&event_type=deployment_failed') == 1
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[-1] == 'INFO: deployment d-3 of application "/b" finished'
+    assert lines[2] == 'INFO: deployment d-2 of application "/a" finished'
+
+    with StubMarathon(deployment_delay=0.2, events=False) as marathon:
+        deployer = cli.MarathonDeployer('test', wait_timeout=5)
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/a']])
+        assert marathon.count('GET', '/v2/deployments') >= 2
+
+    with StubMarathon(deployment_delay=0.2) as marathon:
+        deployer = cli.MarathonDeployer('test')
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications([apps['/a']])
+        assert deployer.deployments == {}
+
+    with StubMarathon(deployment_delay=None) as marathon:
+        deployer = cli.MarathonDeployer('test', wait_timeout=1)
+        deployer.marathon_url = marathon.url
+        with pytest.raises(SystemExit):
+            deployer.deploy_applications([apps['/a']])
+
+    lines = capsys.readouterr().err.splitlines()
+    assert 'ERROR: timed out waiting for deployment d-2 of application "/a"' in lines
+
+
+def test_wait_timeout_with_unrelated_events(pytestconfig):
+    """
+    the wait timeout is enforced while Marathon keeps reporting deployments of other applications.
+    """
+    import threading
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+
+    with StubMarathon(deployment_delay=None) as marathon:
+        stop = threading.Event()
+
+        def unrelated_deployments():
+            count = 0
+            while not stop.wait(0.1):
+                count += 1
+                marathon.finish_deployment('other-%d' % count)
+
+        thread = threading.Thread(target=unrelated_deployments)
+        thread.start()
+        try:
+            deployer = cli.MarathonDeployer('test', wait_timeout=1)
+            deployer.marathon_url = marathon.url
+            start = time.time()
+            with pytest.raises(SystemExit):
+                deployer.deploy_applications([{'id': '/a'}])
+            assert time.time() - start < 3
+        finally:
+            stop.set()
+            thread.join()
+
+
+def test_generate_all_domains(tmpdir):
+    """
+    the application definitions are generated for all domains in a single run, reported per domain.
+    """
+    tmpdir.join('cfg', 'domain.cfg').write(
+        '[DEFAULT]\nmarathon_url = http://localhost\n[tst]\nrelease = 1.0\n[prd]\nrelease = 0.9\n', ensure=True)
+    tmpdir.join('apps', 'a.json').write('{"id": "/a", "env": {"RELEASE": "{{release}}"}}', ensure=True)
+    tmpdir.chdir()
+
+    result = CliRunner().invoke(cli.cli, ['generate', '--all-domains', '--output-directory', 'out'])
+    assert result.exit_code == 0
+
+    for domain_name, release in [('prd', '0.9'), ('tst', '1.0')]:
+        with open(str(tmpdir.join('out', domain_name, 'a.json'))) as f:
+            assert json.load(f)['env']['RELEASE'] == release
+
+    assert [line for line in result.output.splitlines() if 'domain' in line] == \
+        ['INFO: domain "prd"', 'INFO: domain "tst"']
+
+
+def test_unreachable_domain(tmpdir):
+    """
+    a domain whose Marathon cannot be reached is reported as failed, without hiding the report of the other domains.
+    """
+    with StubMarathon([{'id': '/a', 'cmd': 'sleep 3600'}]) as marathon:
+        tmpdir.join('cfg', 'domain.cfg').write(
+            '[prd]\nmarathon_url = http://127.0.0.1:1\n[tst]\nmarathon_url = %s\n' % marathon.url, ensure=True)
+        tmpdir.join('apps', 'a.json').write('{"id": "/a", "cmd": "sleep 3600"}', ensure=True)
+        tmpdir.chdir()
+        result = CliRunner().invoke(cli.cli, ['diff', '--all-domains'])
+
+    assert result.exit_code == 1
+    lines = result.output.splitlines()
+    assert lines.index('INFO: domain "tst"') > lines.index('INFO: domain "prd"')
+    assert 'INFO: no changes to application "/a"' in lines
+    assert any(line.startswith('ERROR: failed for domain "prd", ') for line in lines)
+    assert lines[-1] == 'ERROR: failed for domain "prd"'
+
+
+def test_lazy_imports(pytestconfig):
+    """
+    commands only import the heavy modules they need.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    script = ('import sys\n'
+              'from marathon_release import cli\n'
+              'try:\n'
+              '    cli.cli(sys.argv[1:])\n'
+              'except SystemExit:\n'
+              '    pass\n'
+              'modules = ["requests", "jinja2", "jsondiff", "configparser"]\n'
+              'sys.stdout.write("\\nimported:" + " ".join(m for m in modules if m in sys.modules))\n')
+
+    def imported_modules(*args):
+        output = subprocess.check_output([sys.executable, '-c', script] + list(args), cwd=testdir,
+                                         env=dict(os.environ, PYTHONPATH=str(pytestconfig.rootdir)))
+        return output.decode('utf-8').splitlines()[-1][len('imported:'):].split()
+
+    assert imported_modules('--help') == []
+    assert imported_modules('generate', '--help') == []
+    output_directory = os.path.join(testdir, '.generated')
+    try:
+        assert imported_modules('generate', '--domain-name', 'test', '--output-directory', output_directory) == \
+            ['jinja2', 'configparser']
+    finally:
+        for filename in os.listdir(output_directory):
+            os.remove(os.path.join(output_directory, filename))
+        os.rmdir(output_directory)
+
+
+def test_metrics(pytestconfig, capsys):
+    """
+    the time per phase and the requests per endpoint are recorded, and reported as a table.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test', bulk_fetch_threshold=0)
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+
+    with StubMarathon([dict(apps['/a'], instances=3)]) as marathon:
+        deployer.marathon_url = marathon.url
+        deployer.deploy_applications(list(apps.values()))
+
+    metrics = deployer.metrics.as_dict()
+    assert set(metrics['phases']) == set(['load', 'render', 'fetch', 'diff', 'apply'])
+    assert metrics['phases']['render']['count'] == 2
+    assert set(metrics['apps']['/a']) == set(['render', 'diff', 'apply'])
+
+    endpoints = metrics['endpoints']
+    assert set(endpoints) == set(['GET /v2/apps', 'PUT /v2/apps/{id}', 'POST /v2/apps'])
+    assert endpoints['GET /v2/apps']['count'] == 1
+    assert endpoints['GET /v2/apps']['bytes_received'] > 0
+    assert endpoints['PUT /v2/apps/{id}']['bytes_sent'] > 0
+    assert sum(endpoints['POST /v2/apps']['histogram'].values()) == 1
+
+    capsys.readouterr()
+    cli.report_metrics({'test': deployer.metrics}, True, None)
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].startswith('INFO: metrics for domain "test" in ')
+    assert [line.split()[0] for line in lines[2:7]] == ['apply', 'diff', 'fetch', 'load', 'render']
+
+
+def test_plan_apply(pytestconfig, tmpdir):
+    """
+    a plan is applied without rendering or diffing again, unless an application has changed since.
+    """
+    testdir = os.path.join(str(pytestconfig.rootdir), 'tests')
+    os.chdir(testdir)
+    deployer = cli.MarathonDeployer('test')
+    apps = deployer.load_all_app_definitions(directory=os.path.join(testdir, 'apps'))
+
+    with StubMarathon([dict(apps['/a'], instances=3, version='v1')]) as marathon:
+        deployer.marathon_url = marathon.url
+        plan = deployer.plan_applications([apps['/a'], apps['/b']])
+        assert [(o['action'], o['app']['id'], o['version']) for o in plan['operations']] == [
+            ('update', '/a', 'v1'), ('create', '/b', None)]
+        assert marathon.count('PUT') == marathon.count('POST') == 0
+
+        plan = json.loads(json.dumps(plan))
+        marathon.apps['/a']['version'] = 'v2'
+        deployer = cli.MarathonDeployer('test')
+        deployer.marathon_url = marathon.url
+        deployer.load_application_definition = None
+        with pytest.raises(SystemExit):
+            deployer.apply_plan(plan)
+        assert marathon.count('PUT') == marathon.count('POST') == 0
+
+        marathon.apps['/a']['version'] = 'v1'
+        deployer.apply_plan(plan)
+        assert marathon.count('PUT', '/v2/apps//a') == 1
+        assert marathon.count('POST', '/v2/apps') == 1
+        assert marathon.apps['/a'] == apps['/a']
+
+
+def test_incremental_write(pytestconfig, tmpdir, capsys):
+    """
+    only changed application definitions are written, also by a pool of write workers.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test', write_workers=3)
+    apps = [{'id': '/app-%d' % i, 'instances': 1} for i in range(10)]
+    assert deployer.save_application_definitions(json.loads(json.dumps(apps)), str(tmpdir)) == 10
+
+    unchanged = tmpdir.join('app-0.json')
+    unchanged.setmtime(1000000000)
+    apps[5]['instances'] = 2
+    capsys.readouterr()
+    assert deployer.save_application_definitions(iter(apps), str(tmpdir)) == 10
+
+    assert capsys.readouterr().err == 'INFO: 1 application definitions changed, 9 unchanged.\n'
+    assert unchanged.mtime() == 1000000000
+    assert json.loads(tmpdir.join('app-5.json').read())['instances'] == 2
+    assert sorted(os.listdir(str(tmpdir))) == sorted('app-%d.json' % i for i in range(10))
+
+
+@pytest.mark.parametrize('polling', [False, True])
+def test_watch(tmpdir, capsys, polling):
+    """
+    changed templates and changes in Marathon are reconciled while watching.
+    """
+    import threading
+    import time
+
+    output = []
+
+    def wait_for(expected):
+        deadline = time.time() + 5
+        while expected not in output and time.time() < deadline:
+            time.sleep(0.05)
+            output.extend(capsys.readouterr().err.splitlines())
+        assert expected in output
+
+    with StubMarathon([{'id': '/a', 'instances': 3}]) as marathon:
+        tmpdir.join('cfg', 'domain.cfg').write('[DEFAULT]\nmarathon_url = %s\n[test]\n' % marathon.url, ensure=True)
+        tmpdir.join('apps', 'a.json').write('{"id": "/a", "instances": {{instances}}}', ensure=True)
+        tmpdir.join('apps', 'a.cfg').write('[DEFAULT]\ninstances = 2\n')
+        tmpdir.chdir()
+        deployer = cli.MarathonDeployer('test', dry_run=True)
+        stop = threading.Event()
+        watcher = threading.Thread(target=deployer.watch_applications,
+                                   kwargs={'interval': 0.1, 'refresh_interval': 0.2, 'polling': polling, 'stop': stop})
+        watcher.start()
+        try:
+            wait_for('INFO: updating application "/a"')
+
+            tmpdir.join('apps', 'b.json').write('{"id": "/b"}')
+            wait_for('INFO: deploying new application "/b"')
+
+            get_root_group_version = deployer.get_root_group_version
+            failed = []
+
+            def failing_root_group_version():
+                if len(failed) == 0:
+                    failed.append(True)
+                    raise ValueError('No JSON object could be decoded')
+                return get_root_group_version()
+
+            deployer.get_root_group_version = failing_root_group_version
+            wait_for('WARN: failed to refresh the deployed applications, No JSON object could be decoded')
+
+            marathon.apps['/a'] = {'id': '/a', 'instances': 2}
+            marathon.version += 1
+            wait_for('INFO: application "/a" is in sync')
+            assert marathon.count('GET', '/v2/apps') == 2
+            assert marathon.count('GET', '/v2/apps//a') == 0
+        finally:
+            stop.set()
+            watcher.join()
+
+
+def test_leader_failover(pytestconfig, capsys):
+    """
+    requests are sent to the leader of the masters, which is discovered again after a failure or a redirect.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test')
+
+    with StubMarathon([{'id': '/a'}]) as standby, StubMarathon([{'id': '/a'}]) as leader:
+        standby.leader = leader.leader = leader.netloc
+        deployer.marathon_url = 'http://127.0.0.1:1, %s,%s/' % (standby.url, leader.url)
+        assert list(deployer.get_all_applications()) == ['/a']
+        assert leader.count('GET', '/v2/apps') == 1
+        assert standby.count('GET', '/v2/apps') == 0
+
+        standby.leader = leader.leader = standby.netloc
+        leader.redirect_to = standby.url
+        assert deployer.get_application('/a') == {'id': '/a'}
+        assert leader.count('GET', '/v2/apps//a') == 1
+        assert standby.count('GET', '/v2/apps//a') == 1
+        assert standby.count('GET', '/v2/leader') == 2
+        assert leader.count('GET', '/v2/leader') == 0
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0].startswith('WARN: Marathon master http://127.0.0.1:1 is not available, ')
+    assert lines[1:] == ['INFO: Marathon master %s is no longer the leader' % leader.url]
+
+
+def test_write_retries(pytestconfig, capsys):
+    """
+    writes are retried while the application is locked or Marathon is unavailable.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test')
+    deployer.scheduler.base_delay = 0.01
+
+    with StubMarathon() as marathon:
+        deployer.marathon_url = marathon.url
+        marathon.failures = [
+            (409, {'message': 'App is locked by one or more deployments.', 'deployments': [{'id': 'd-0'}]}, {}),
+            (503, {'message': 'no leader'}, {'Retry-After': '0'})]
+        deployer.deploy_new_application({'id': '/a'})
+        assert marathon.count('POST', '/v2/apps') == 3
+        assert marathon.apps['/a'] == {'id': '/a'}
+
+        marathon.failures = [(409, {'message': 'An app with id [/a] already exists.'}, {})]
+        deployer.deploy_new_application({'id': '/a'})
+        assert marathon.count('POST', '/v2/apps') == 4
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[1].startswith('WARN: POST /v2/apps returned status code 409, retrying in ')
+    assert lines[2] == 'WARN: POST /v2/apps returned status code 503, retrying in 0.0s'
+    assert lines[-1] == 'ERROR: deployment for application "/a" failed, with status code 409'
+
+
+def test_adaptive_write_limit():
+    """
+    the number of writes in flight is halved when Marathon is overloaded, and grows slowly otherwise.
+    """
+    scheduler = cli.WriteScheduler(8)
+    started = 1.0
+    scheduler.acquire()
+    scheduler.release(started, 0.01, overloaded=True)
+    assert scheduler.limit == 4
+    scheduler.acquire()
+    scheduler.release(started, 0.01, overloaded=True)
+    assert scheduler.limit == 4
+    for _ in range(5):
+        scheduler.acquire()
+        scheduler.release(time.time(), 0.01, overloaded=False)
+    assert int(scheduler.limit) == 5
+    scheduler.acquire()
+    scheduler.release(time.time(), 1.0, overloaded=False)
+    assert int(scheduler.limit) == 2
+
+
+def test_select_app_definitions(tmpdir):
+    """
+    only the templates matching the selectors are rendered, using the index to look up the labels.
+    """
+    tmpdir.join('cfg', 'domain.cfg').write('[DEFAULT]\nmarathon_url = http://localhost\n[test]\nteam = web\n',
+                                           ensure=True)
+    tmpdir.join('apps', 'payments-api.json').write('{"id": "/payments-api", "labels": {"TEAM": "pay"}}', ensure=True)
+    tmpdir.join('apps', 'payments-db.json').write('{"id": "/payments-db", "labels": {"TEAM": "pay", "DB": "pg"}}')
+    tmpdir.join('apps', 'shop.json').write('{"id": "/shop", "labels": {"TEAM": "{{team}}"}}')
+    tmpdir.chdir()
+    index_dir = str(tmpdir.join('index'))
+
+    def select(*selectors):
+        deployer = cli.MarathonDeployer('test', index_dir=index_dir)
+        apps = deployer.select_app_definitions(selectors, './apps')
+        return sorted(apps), deployer.metrics.as_dict()['phases'].get('render', {'count': 0})['count']
+
+    assert select('/payments-*') == (['/payments-api', '/payments-db'], 2)
+    assert not tmpdir.join('index').exists()
+
+    assert select('TEAM=web') == (['/shop'], 3)
+    assert select('TEAM=web', 'TEAM=pay,!DB,DB!=pg') == (['/payments-api', '/shop'], 2)
+    assert select('/payments-*,DB') == (['/payments-db'], 1)
+
+    tmpdir.join('apps', 'shop.json').write('{"id": "/shop", "labels": {"TEAM": "shop"}}')
+    assert select('TEAM=shop') == (['/shop'], 1)
+    assert select('TEAM=web') == ([], 0)
+
+
+def test_prune_applications(pytestconfig, capsys):
+    """
+    undefined applications making up a whole group are deleted with their group, the others one by one.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test', parallelism=4)
+    deployed = ['/a', '/stale', '/feature/x/web', '/feature/x/api', '/feature/y', '/shared/db', '/shared/cache',
+                '/pods/web']
+
+    with StubMarathon([{'id': app_id, 'labels': {}} for app_id in deployed]) as marathon:
+        marathon.pods = ['/pods/worker']
+        marathon.apps['/shared/db']['labels'] = {'KEEP': 'true'}
+        deployer.marathon_url = marathon.url
+        deployer.prune_applications(['/a'], [cli.parse_selector('!KEEP')])
+
+        assert marathon.requests[0] == ('GET', '/v2/apps')
+        assert sorted(r for r in marathon.requests if r[0] == 'DELETE') == [
+            ('DELETE', '/v2/apps//pods/web'), ('DELETE', '/v2/apps//shared/cache'), ('DELETE', '/v2/apps//stale'),
+            ('DELETE', '/v2/groups//feature')]
+        assert sorted(marathon.apps) == ['/a', '/shared/db']
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[0] == 'INFO: deleting group "/feature" with 3 applications'
+    assert lines[-1].startswith('INFO: deleted 6 applications, 3 of them in 1 groups, in ')
+
+
+def test_delete_without_rendering(tmpdir, monkeypatch):
+    """
+    delete takes the ids of the defined applications from the names of the templates, without rendering them.
+    """
+    monkeypatch.setattr(cli.MarathonDeployer, 'render_application_definition',
+                        lambda self, path: pytest.fail('rendered %s' % path))
+    with StubMarathon([{'id': '/a'}, {'id': '/stale'}]) as marathon:
+        tmpdir.join('cfg', 'domain.cfg').write('[tst]\nmarathon_url = %s\n' % marathon.url, ensure=True)
+        tmpdir.join('apps', 'a.json').write('{"id": "/a", "cmd": "{{command}}"}', ensure=True)
+        tmpdir.chdir()
+        result = CliRunner().invoke(cli.cli, ['delete', '--domain-name', 'tst'])
+
+        assert result.exit_code == 0
+        assert sorted(marathon.apps) == ['/a']
+
+
+def test_prune_applications_deployed_since_listing(pytestconfig, capsys):
+    """
+    a group is not deleted as a whole when an application was deployed into it after the applications were listed.
+    """
+    os.chdir(os.path.join(str(pytestconfig.rootdir), 'tests'))
+    deployer = cli.MarathonDeployer('test', parallelism=4)
+
+    with StubMarathon([{'id': app_id} for app_id in ['/a', '/feature/web', '/feature/api']]) as marathon:
+        deployer.marathon_url = marathon.url
+        list_deployed_applications = deployer.list_deployed_applications
+
+        def list_and_deploy():
+            apps = list_deployed_applications()
+            marathon.apps['/feature/new'] = {'id': '/feature/new'}
+            return apps
+
+        deployer.list_deployed_applications = list_and_deploy
+        deployer.prune_applications(['/a'])
+
+        assert ('GET', '/v2/groups?embed=group.groups&embed=group.apps&embed=group.pods') in marathon.requests
+        assert sorted(r for r in marathon.requests if r[0] == 'DELETE') == [
+            ('DELETE', '/v2/apps//feature/api'), ('DELETE', '/v2/apps//feature/web')]
+        assert sorted(marathon.apps) == ['/a', '/feature/new']
+
+    lines = capsys.readouterr().err.splitlines()
+    assert lines[-1].startswith('INFO: deleted 2 applications, 0 of them in 0 groups, in ')